@@ -1,15 +1,19 @@
-import requests, fabric
-import sys, logging, time
+import requests
+from json_stream import JsonArrayStream
+from typing import Callable, Container, Iterator
+import sys, logging, math, threading, time
 import config
-import citygeo_secrets
+import secrets_cache
 
 
 global logger
 logger = logging.getLogger('main')
 
+_token_lock = threading.Lock()  # Held while the API token is refreshed, see refresh_api_token()
 
-def connect_to_api(creds: dict, data=None, attempt:int=0, run_local:bool=False) -> requests.models.Response:
-    '''Get the data from the API'''
+
+def connect_to_api(creds: dict, data=None, attempt:int=0, run_local:bool=False, stream:bool=False) -> requests.models.Response:
+    '''Get the data from the API. If `stream`, the body is read by the caller as it arrives.'''
     logger.info(f'Accessing API - attempt {attempt}\n')
     headers = {
         'Authorization': f'Bearer {creds[config.API_SECRET]["API_KEY"]}',
@@ -17,47 +21,110 @@ def connect_to_api(creds: dict, data=None, attempt:int=0, run_local:bool=False)
     }
     if run_local: 
         return requests.get(creds[config.API_SECRET]['API_URL'], 
-                            headers=headers, params=data, verify=False)
+                            headers=headers, params=data, verify=False, stream=stream, 
+                            timeout=config.API_TIMEOUT_SECONDS)
     else: 
         return requests.get(creds[config.API_SECRET]['API_URL'], 
-                            headers=headers, params=data)
+                            headers=headers, params=data, stream=stream, 
+                            timeout=config.API_TIMEOUT_SECONDS)
 
 
-def get_asset_data(run_local: bool) -> dict: 
+def get_asset_data(run_local: bool, stream: bool = False, page: int = None) -> dict | requests.Response: 
     '''Get asset data from API
         
     If the API indicates an expired token, attempt to generate a new token and get 
     the data one additional time before failing. If successful, will write this 
     new API token to secrets manager
     - `run_local`: If True, do not verify SSL certificates
+    - `stream`: If True, return the response before its body is read - see iter_asset_records()
+    - `page`: Page number to request, if not the API's default (first) page
     '''
-    response = citygeo_secrets.connect_with_secrets(
-        connect_to_api, config.API_SECRET, attempt=0, run_local=run_local)
+    params = {'page': page} if page != None else None
+    creds = secrets_cache.get_secrets(config.API_SECRET)
+    response = connect_to_api(creds, data=params, attempt=0, run_local=run_local, stream=stream)
     
     if response.ok:
-        return response.json()
+        return response if stream else response.json()
     elif response.status_code in (401, 500): # Access token needs to be refreshed
         logger.info(f'Received {response.status_code} status code - attempting to refresh token\n')
-        new_api_key = citygeo_secrets.connect_with_secrets(
-            request_new_access_token, config.API_TOKEN_REFRESH_SECRET)
-        creds = citygeo_secrets.get_secrets(config.API_SECRET)
+        
+        def is_ready(api_key: str) -> bool: 
+            nonlocal response
+            response.close()
+            creds[config.API_SECRET]['API_KEY'] = api_key
+            response = connect_to_api(creds=creds, data=params, attempt=1, run_local=run_local, 
+                                      stream=stream)
+            return response.ok
+        
+        if refresh_api_token(creds[config.API_SECRET]['API_KEY'], is_ready) != None: 
+            return response if stream else response.json()
+    
+    sys.exit(f"Request failed with status code: {response.status_code}")
+
+
+def refresh_api_token(stale_key: str, is_ready: Callable[[str], bool]) -> dict: 
+    '''Replace the API token `stale_key` with a new one, returning the token response 
+    ("access_token" and "expires_in"), or None if the new token never became ready
+    
+    However many threads find `stale_key` rejected, only one new token is requested; 
+    the others get the token that already replaced it (without "expires_in"). 
+    The new token is only saved to the secrets manager once `is_ready(new_key)` is 
+    True, which is polled with an increasing delay for up to API_TOKEN_READY_SECONDS.
+    - `stale_key`: API token that is expired or about to expire
+    - `is_ready`: Returns whether a request with the given token succeeds'''
+    with _token_lock: 
+        # Another process (or thread) may already have replaced the token
+        secrets_cache.invalidate(config.API_SECRET)
+        current_key = secrets_cache.get_secrets(config.API_SECRET)[config.API_SECRET]['API_KEY']
+        if current_key != stale_key: 
+            logger.info('API token was already refreshed\n')
+            return {'access_token': current_key} if is_ready(current_key) else None
+        
+        token = secrets_cache.connect_with_secrets(
+            request_new_access_token, config.API_TOKEN_REFRESH_SECRET, full_response=True)
+        new_api_key = token['access_token']
+        logger.debug(f'Old API Key ends with: {stale_key[-5:]}')
+        logger.debug(f'New API Key ends with: {new_api_key[-5:]}')
 
         # "Heisenbug" appears only in production but not in debugging. 
         # Perhaps because this function runs in < 1 second in production, and their 
         # API can't reset to a new token fast enough, causing it to reissue a 401 HTTP error...
-        old_api_key = creds[config.API_SECRET]['API_KEY']
-        logger.debug(f'Old API Key ends with: {old_api_key[-5:]}')
-        creds[config.API_SECRET]['API_KEY'] = new_api_key
-        logger.debug(f'New API Key ends with: {new_api_key[-5:]}')
-        logger.debug('Sleeping for 5 seconds')
-        time.sleep(5) # Allow their API time to instate the new token
-
-        response = connect_to_api(creds=creds, attempt=1, run_local=run_local)
-        if response.ok: 
-            citygeo_secrets.update_secret(config.API_SECRET, {'API_KEY': new_api_key})
-            return response.json()
+        # So poll until the new token is accepted rather than using it straight away. 
+        start = time.monotonic()
+        delay = 0.25
+        while not is_ready(new_api_key): 
+            if time.monotonic() - start + delay > config.API_TOKEN_READY_SECONDS: 
+                logger.error(f'New API token not accepted after {time.monotonic() - start:.1f}s\n')
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+        logger.info(f'New API token accepted after {time.monotonic() - start:.1f}s\n')
+        secrets_cache.update_secret(config.API_SECRET, {'API_KEY': new_api_key})
+        return token
+
+
+def iter_asset_records(run_local: bool, fields: Container[str]) -> Iterator[dict]: 
+    '''Yield asset records from the API one at a time, parsing each response as it 
+    arrives and keeping only the keys (lowercased) in `fields`
     
-    sys.exit(f"Request failed with status code: {response.status_code}")
+    If the first response reports more entities ("totalEntityCount") than fit on 
+    a page ("pageLength"), the remaining pages are requested in turn.
+    - `run_local`: If True, do not verify SSL certificates
+    - `fields`: Lowercase names of the fields to keep
+    '''
+    page, page_count = 1, 1
+    while page <= page_count: 
+        response = get_asset_data(run_local, stream=True, page=page if page > 1 else None)
+        with response: 
+            stream = JsonArrayStream(
+                response.iter_content(config.ASSET_STREAM_CHUNK_BYTES), key='data')
+            for record in stream: 
+                yield {k.lower(): v for k, v in record.items() if k.lower() in fields}
+        total, length = stream.metadata.get('totalEntityCount'), stream.metadata.get('pageLength')
+        if page == 1 and total and length and total > length: 
+            page_count = math.ceil(total / length)
+            logger.info(f'Assets API returned {length:,} of {total:,} assets - requesting {page_count} pages\n')
+        page += 1
 
 
 def request_new_access_token(creds: dict, full_response:bool=False) -> str | dict: 
@@ -69,7 +136,7 @@ def request_new_access_token(creds: dict, full_response:bool=False) -> str | dic
     url = creds[config.API_TOKEN_REFRESH_SECRET].pop('url')
     data = creds[config.API_TOKEN_REFRESH_SECRET]
     
-    response = requests.post(url, data)
+    response = requests.post(url, data, timeout=config.API_TIMEOUT_SECONDS)
     logger.info(f'New token acquired - expires in {response.json()["expires_in"]:,} seconds\n')
 
     if not full_response: 
@@ -79,8 +146,9 @@ def request_new_access_token(creds: dict, full_response:bool=False) -> str | dic
 
 
 
-def get_sftp_conn(sftp_creds: dict) -> fabric.Connection: 
+def get_sftp_conn(sftp_creds: dict) -> 'fabric.Connection': 
     '''Return SFTP connection'''
+    import fabric # Along with paramiko, only imported by runs that upload
 
     # look_for_keys: False is necessary otherwise paramiko will incorrectly attempt
     # to use our user's keys in our ~/.ssh folder and fail without ever trying
@@ -91,11 +159,3 @@ def get_sftp_conn(sftp_creds: dict) -> fabric.Connection:
         connect_kwargs={'password': creds['password'], 'look_for_keys': False},
         )
     return sftp_conn
-
-
-def upload_to_sftp(local_filename: str, remote_filename: str): 
-    '''Upload a file to SFTP'''
-    sftp_conn = citygeo_secrets.connect_with_secrets(get_sftp_conn, config.SFTP_SECRET)
-    with sftp_conn.sftp() as sftp_client: 
-        sftp_client.put(local_filename, remote_filename)
-    logger.info(f'Successfully uploaded file to SFTP server at "{remote_filename}"\n')
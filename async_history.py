@@ -0,0 +1,238 @@
+import httpx
+import config as conf
+from run_asset_history import consume_page, get_page_count, get_cache_key, log_asset_history
+from run_asset_history import bearer_key, refresh_base_headers
+from history_writer import HistoryWriter, page_columns
+from concurrency import ConcurrencyController, OVERLOAD_STATUSES, parse_retry_after
+from scheduler import DeadlineScheduler
+from response_cache import ResponseCache
+import asyncio, datetime as dt, zoneinfo, logging, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class TokenBucket():
+    '''Limit API calls to both the controller's current number of concurrent calls
+    and a maximum number of calls per minute
+    ```
+    bucket = TokenBucket(controller, calls_per_minute=200)
+    async with bucket:
+        # make one API call
+    ```
+    Tokens refill continuously at `calls_per_minute / 60` per second up to `burst`,
+    so calls are spread evenly over the minute rather than sent all at once. No
+    call starts during a Retry-After pause.
+    '''
+    def __init__(self, controller: ConcurrencyController, calls_per_minute: int, burst: int = 1):
+        self.controller = controller
+        self.rate = calls_per_minute / 60
+        self.burst = burst
+        self.in_flight = 0
+        self.queued = 0
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._slots = asyncio.Condition()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def _take_slot(self):
+        while True:
+            pause = self.controller.pause_remaining()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            async with self._slots:
+                if self.in_flight < self.controller.limit:
+                    self.in_flight += 1
+                    return
+                try: # Also wake periodically in case the limit was raised
+                    await asyncio.wait_for(self._slots.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _take_token(self):
+        async with self._lock: # Waiters take tokens in the order they arrived
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def acquire(self):
+        '''Wait for both a free concurrency slot and a token'''
+        self.queued += 1
+        try:
+            await self._take_slot()
+            try:
+                await self._take_token()
+            except BaseException:
+                await self.release()
+                raise
+        finally:
+            self.queued -= 1
+
+    async def release(self):
+        '''Free the concurrency slot of a finished call'''
+        async with self._slots:
+            self.in_flight -= 1
+            self._slots.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.release()
+
+
+async def get_page(client: httpx.AsyncClient, bucket: TokenBucket, url: str,
+                   headers: dict, page: int, cache: ResponseCache = None,
+                   cache_key: str = None) -> dict:
+    '''Get one page of observations, reporting each call to the concurrency
+    controller as in run_asset_history.get_page() and retrying on a 429, 5xx,
+    timeout, or connection error. Uses the response cache as run_asset_history.get_page()
+    does if both `cache` and `cache_key` are given. A 401 refreshes the API token, 
+    updating `headers` - shared by every task - in place, and is retried once.'''
+    controller = bucket.controller
+    entry = None
+    conditional_headers = {}
+    if cache != None and cache_key != None:
+        entry = cache.get(cache_key)
+        if entry != None and entry.fresh:
+            return entry.data
+        if entry != None:
+            conditional_headers = entry.conditional_headers()
+    shared_headers, refreshed = headers, False
+    headers = {**shared_headers, **conditional_headers}
+    for attempt in range(conf.API_RETRIES + 1):
+        retry_after = None
+        try:
+            async with bucket:
+                start = time.monotonic()
+                response = await client.get(url, headers=headers, params={'page': page})
+                latency = time.monotonic() - start
+            if response.status_code not in OVERLOAD_STATUSES:
+                controller.record_success(latency)
+                if response.status_code == 304 and entry != None:
+                    cache.revalidated(cache_key)
+                    return entry.data
+                if response.status_code == 401 and not refreshed and attempt < conf.API_RETRIES:
+                    refreshed = True
+                    new_headers = await asyncio.to_thread(refresh_base_headers, bearer_key(headers), url)
+                    if new_headers != None:
+                        shared_headers.update(new_headers)
+                        headers = {**shared_headers, **conditional_headers}
+                        continue
+                response.raise_for_status()
+                if cache != None and cache_key != None:
+                    cache.put(cache_key, response.text, response.headers)
+                return response.json()
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            controller.record_overload(f'HTTP {response.status_code}', retry_after)
+            if attempt == conf.API_RETRIES:
+                response.raise_for_status()
+        except httpx.TimeoutException:
+            controller.record_overload('timeout')
+            if attempt == conf.API_RETRIES:
+                raise
+        except httpx.TransportError:
+            if attempt == conf.API_RETRIES:
+                raise
+        await asyncio.sleep(retry_after if retry_after != None else 0.5 * (2 ** attempt))
+
+
+async def get_asset_history(client: httpx.AsyncClient, bucket: TokenBucket, base_url: str,
+                            headers: dict, id: str, watermark: dt.datetime,
+                            now: dt.datetime, writer: HistoryWriter, cache: ResponseCache):
+    '''Get the history of one asset, paging as in run_asset_history.get_asset_history()
+    and pushing each page to the writer'''
+    url = f'{base_url}{id}/observations'
+    page = 1
+    record_count = 0
+    j = j_first = await get_page(client, bucket, url, headers, page)
+    page_count = get_page_count(j)
+    fetched = []
+    while True:
+        data, reason = consume_page(j, watermark, now)
+        if reason == None and page >= page_count:
+            reason = 'last page'
+        record_count += len(data)
+        # put() may block while the writer's queue is full, so keep it off the event loop
+        await asyncio.to_thread(writer.put, id, page_columns(id, data, now), reason != None)
+        if reason != None:
+            last_page = page - 1 if reason == 'empty' else page
+            break
+        if fetched == []: # Request the next window of pages concurrently
+            window = range(page + 1, min(page + conf.PAGE_FANOUT, page_count) + 1)
+            fetched = [asyncio.create_task(get_page(
+                client, bucket, url, headers, p, cache,
+                get_cache_key(id, j_first['totalEntityCount'], p))) for p in window]
+        j = await fetched.pop(0)
+        page += 1
+    for task in fetched: # Pages beyond the cutoff are no longer needed
+        task.cancel()
+
+    log_asset_history(url, record_count, last_page, reason, consumer='asyncio task')
+
+
+async def report_progress(bucket: TokenBucket, done: list, total: int, interval: int = 10):
+    '''Periodically log the in-flight and queued call counts'''
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f'asyncio engine: {bucket.in_flight} call(s) in flight, '
+                    f'{bucket.queued} queued, {len(done):,} of {total:,} IDs complete\n')
+
+
+async def fetch_all(scheduler: DeadlineScheduler, base_url: str, headers: dict, verify: bool,
+                    writer: HistoryWriter, controller: ConcurrencyController,
+                    cache: ResponseCache, watermarks: dict):
+    '''Get the history of the scheduler's ids through one shared connection pool and
+    token bucket, with one worker task per possible concurrent call'''
+    bucket = TokenBucket(controller, conf.MAX_CALLS_PER_MINUTE)
+    limits = httpx.Limits(max_connections=controller.maximum,
+                          max_keepalive_connections=controller.maximum)
+    now = dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
+    done = []
+
+    async def worker():
+        while (id := scheduler.next_id()) != None: # Until none remain or the deadline passes
+            try: # Record a failure in the work queue so that the other ids still complete
+                await get_asset_history(client, bucket, base_url, headers, id,
+                                        watermarks.get(id), now, writer, cache)
+            except Exception as e:
+                logger.error(f'Failed to get history of {id}: {e!r}')
+                await asyncio.to_thread(writer.fail, id, e)
+            done.append(id)
+
+    async with httpx.AsyncClient(limits=limits, verify=verify,
+                                 timeout=conf.API_TIMEOUT_SECONDS) as client:
+        reporter = asyncio.create_task(report_progress(bucket, done, scheduler.total))
+        try:
+            await asyncio.gather(*(worker() for _ in range(controller.maximum)))
+        finally:
+            reporter.cancel()
+
+
+def fetch_histories(scheduler: DeadlineScheduler, base_url: str, headers: dict, verify: bool,
+                    writer: HistoryWriter, controller: ConcurrencyController,
+                    cache: ResponseCache = None, watermarks: dict = None):
+    '''Get the history of each of the scheduler's ids with asyncio rather than a
+    ThreadPoolExecutor, holding the call rate at config.MAX_CALLS_PER_MINUTE
+    - `scheduler`: DeadlineScheduler handing out ids in priority order until the deadline
+    - `verify`: Whether to verify SSL certificates
+    - `writer`: HistoryWriter that each page is pushed to
+    - `controller`: ConcurrencyController that sets the number of concurrent calls
+    - `cache`: ResponseCache of older observation pages, or None to not cache
+    - `watermarks`: Dict of id -> newest stored lastseentime, used in incremental mode'''
+    logger.info(f'Using asyncio engine - up to {controller.maximum} concurrent calls '
+                f'and {conf.MAX_CALLS_PER_MINUTE} calls per minute\n')
+    return asyncio.run(fetch_all(
+        scheduler, base_url, headers, verify, writer, controller, cache,
+        watermarks if watermarks != None else {}))
@@ -0,0 +1,125 @@
+import sqlalchemy as sa
+from typing import Iterable, Sequence
+import datetime as dt, logging
+
+
+global logger
+logger = logging.getLogger('main')
+
+CHUNK_SIZE = 64 * 1024  # Characters sent to the server per write
+_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def encode_value(value) -> str:
+    '''Encode one value for the text format of COPY, returning None for NULL
+
+    Handles None/NaN/NaT, tz-aware datetimes (pandas Timestamps included, written
+    with their UTC offset so that timestamptz columns keep the right instant),
+    booleans, and numpy scalars'''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    try:
+        if value != value: # NaN and NaT
+            return None
+    except TypeError: # pandas.NA
+        return None
+    if isinstance(value, (dt.datetime, dt.date, dt.time)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if hasattr(value, 'item'): # numpy scalar
+        return encode_value(value.item())
+    return str(value)
+
+
+def encode_row(row: Sequence) -> str:
+    '''Encode one row as a line of the text format of COPY'''
+    fields = []
+    for value in row:
+        value = encode_value(value)
+        fields.append('\\N' if value is None else value.translate(_ESCAPES))
+    return '\t'.join(fields) + '\n'
+
+
+def iter_chunks(rows: Iterable[Sequence]) -> Iterable[str]:
+    '''Group encoded rows into chunks of roughly CHUNK_SIZE characters'''
+    chunk, size = [], 0
+    for row in rows:
+        line = encode_row(row)
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class _ChunkReader():
+    '''Minimal file-like object over iter_chunks() for psycopg2's copy_expert()'''
+    def __init__(self, chunks: Iterable[str]):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def quote_ident(name: str) -> str:
+    '''Quote a Postgres identifier'''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def copy_rows(dbapi_conn, table_name: str, columns: Sequence[str],
+              rows: Iterable[Sequence], schema: str = None) -> int:
+    '''Stream rows into a table with `COPY ... FROM STDIN`, returning the row count
+
+    Works with both psycopg (3) connections, as used by SQLAlchemy, and psycopg2
+    connections, as used by peewee. The rows are written in the caller's transaction.
+    #### Parameters
+    - `dbapi_conn`: psycopg or psycopg2 connection
+    - `table_name`: Unquoted table name
+    - `columns`: Unquoted column names, in the order of the values of each row
+    - `rows`: Iterable of sequences of values
+    - `schema`: Unquoted schema name, if any'''
+    target = quote_ident(table_name)
+    if schema != None:
+        target = f'{quote_ident(schema)}.{target}'
+    stmt = f'COPY {target} ({", ".join(quote_ident(c) for c in columns)}) FROM STDIN'
+
+    count = 0
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    with dbapi_conn.cursor() as cursor:
+        if hasattr(cursor, 'copy'): # psycopg 3
+            with cursor.copy(stmt) as copy:
+                for chunk in iter_chunks(counted(rows)):
+                    copy.write(chunk)
+        else: # psycopg2
+            cursor.copy_expert(stmt, _ChunkReader(iter_chunks(counted(rows))), size=CHUNK_SIZE)
+    logger.debug(f'{stmt} - {count:,} rows')
+    return count
+
+
+def copy_columns(conn: sa.Connection, table: sa.Table, columns: dict[str, list]) -> int:
+    '''Stream column buffers (column name -> list of values, all the same length)
+    into an SQLAlchemy table with COPY within the connection's current transaction,
+    returning the row count. Columns of the table missing from `columns` are NULL.'''
+    names = [c.name for c in table.columns if c.name in columns]
+    return copy_rows(
+        conn.connection.driver_connection, table.name, names,
+        zip(*(columns[name] for name in names)), schema=table.schema)
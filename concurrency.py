@@ -0,0 +1,148 @@
+import config as conf
+import collections, email.utils, logging, threading, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value: str) -> float:
+    '''Return the seconds to wait from a Retry-After header (seconds or HTTP-date),
+    or None if missing or unparseable'''
+    if value == None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ConcurrencyController():
+    '''AIMD (additive-increase/multiplicative-decrease) controller of the number of
+    concurrent calls to the Visium API
+
+    Each healthy call (latency at or below `latency_target` while the recent error
+    rate is at or below `max_error_rate`) counts toward raising the limit by one;
+    the limit rises once per `limit` such calls. A 429, 5xx, or timeout halves the
+    limit, at most once per `cooldown` seconds so that a burst of failures from the
+    same overload only cuts once, and a Retry-After header pauses all new calls.
+    If not `adaptive`, the limit stays at `initial` but Retry-After is still honored.
+    Unless `exceed_safe_limit`, `maximum` is capped at conf.MAX_CONCURRENT_CALLS,
+    the vendor's recommended safe limit.
+    '''
+    def __init__(self, initial: int, minimum: int = conf.ADAPTIVE_MIN_CALLS,
+                 maximum: int = conf.ADAPTIVE_MAX_CALLS, adaptive: bool = True,
+                 latency_target: float = conf.ADAPTIVE_LATENCY_TARGET,
+                 max_error_rate: float = conf.ADAPTIVE_MAX_ERROR_RATE,
+                 cooldown: float = conf.ADAPTIVE_COOLDOWN_SECONDS, window: int = 100,
+                 exceed_safe_limit: bool = conf.ADAPTIVE_EXCEED_SAFE_LIMIT):
+        if maximum > conf.MAX_CONCURRENT_CALLS and not exceed_safe_limit:
+            logger.warning(f'Capping the adaptive concurrency limit at {conf.MAX_CONCURRENT_CALLS} '
+                           f'(MAX_CONCURRENT_CALLS) - set ADAPTIVE_EXCEED_SAFE_LIMIT to allow {maximum}')
+            maximum = conf.MAX_CONCURRENT_CALLS
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self.maximum = maximum if adaptive else initial
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.paused_until = 0.0
+        self.decisions = []  # (seconds since start, old limit, new limit, reason)
+        self._start = time.monotonic()
+        self._last_decrease = -cooldown
+        self._healthy = 0
+        self._recent = collections.deque(maxlen=window)  # True for each error
+        self._lock = threading.Lock()
+
+    def error_rate(self) -> float:
+        '''Fraction of the most recent calls that were overloaded'''
+        return sum(self._recent) / len(self._recent) if self._recent else 0.0
+
+    def _decide(self, new_limit: int, reason: str):
+        elapsed = time.monotonic() - self._start
+        self.decisions.append((elapsed, self.limit, new_limit, reason))
+        log = logger.info if new_limit <= self.limit else logger.debug
+        log(f'Concurrency limit {self.limit} -> {new_limit} ({reason})')
+        self.limit = new_limit
+
+    def record_success(self, latency: float):
+        '''Record a call that did not indicate overload'''
+        with self._lock:
+            self._recent.append(False)
+            if not self.adaptive:
+                return
+            if latency > self.latency_target or self.error_rate() > self.max_error_rate:
+                self._healthy = 0
+                return
+            self._healthy += 1
+            if self._healthy >= self.limit and self.limit < self.maximum:
+                self._healthy = 0
+                self._decide(self.limit + 1, f'healthy, latency {latency:.2f}s')
+
+    def record_overload(self, reason: str, retry_after: float = None):
+        '''Record a 429, 5xx, or timeout, with the Retry-After seconds if given'''
+        with self._lock:
+            self._recent.append(True)
+            self._healthy = 0
+            now = time.monotonic()
+            if retry_after != None and now + retry_after > self.paused_until:
+                self.paused_until = now + retry_after
+                logger.info(f'Pausing new calls for {retry_after:.1f}s per Retry-After ({reason})')
+            if self.adaptive and now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                new_limit = max(self.minimum, self.limit // 2)
+                if new_limit != self.limit:
+                    self._decide(new_limit, reason)
+
+    def pause_remaining(self) -> float:
+        '''Seconds until new calls may start because of a Retry-After header'''
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def summary(self) -> str:
+        '''Summarize the decisions made during this run'''
+        if not self.adaptive:
+            return f'Concurrency fixed at {self.limit}, error rate {self.error_rate():.1%}'
+        limits = [self.limit] + [d[1] for d in self.decisions]
+        return (f'Concurrency controller made {len(self.decisions)} decision(s): '
+                f'min {min(limits)}, max {max(limits)}, final {self.limit}, '
+                f'recent error rate {self.error_rate():.1%}')
+
+
+class ThreadLimiter():
+    '''Block threads so that no more calls than the controller's current limit run
+    at once, and none start during a Retry-After pause
+    ```
+    limiter = ThreadLimiter(controller)
+    with limiter:
+        # make one API call
+    ```
+    '''
+    def __init__(self, controller: ConcurrencyController):
+        self.controller = controller
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while True:
+                pause = self.controller.pause_remaining()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight < self.controller.limit:
+                    break
+                else: # Also wake periodically in case the limit was raised
+                    self._condition.wait(1)
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *args):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
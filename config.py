@@ -12,9 +12,53 @@ SCHEMA = 'citygeo'
 VIEWER_SCHEMA = 'viewer_cco'
 
 MAX_CONCURRENT_CALLS = 20  # Safe limit recommended by InThing, owner of Visium API
+MAX_CALLS_PER_MINUTE = 200  # Rate limit of each Visium API instance
+API_TIMEOUT_SECONDS = 60  # Max seconds to connect to, or wait for data from, the Visium API
+API_RETRIES = 5  # Retries of a 429, 5xx, or timeout from the asset history API
+ADAPTIVE_MIN_CALLS = 2  # Bounds of the adaptive concurrency controller (--adaptive)
+ADAPTIVE_MAX_CALLS = MAX_CONCURRENT_CALLS
+ADAPTIVE_EXCEED_SAFE_LIMIT = False  # Opt in to an ADAPTIVE_MAX_CALLS above MAX_CONCURRENT_CALLS
+ADAPTIVE_LATENCY_TARGET = 2.0  # Seconds; slower calls do not raise the limit
+ADAPTIVE_MAX_ERROR_RATE = 0.02  # Higher recent error rates do not raise the limit
+ADAPTIVE_COOLDOWN_SECONDS = 5.0  # Min seconds between two cuts of the limit
+HISTORY_QUEUE_MAX_ATTEMPTS = 5  # Attempts at an asset's history before it is no longer claimed
+HISTORY_DEADLINE_SECONDS = 480  # Seconds into a run after which no new asset history is started
+HISTORY_PRIORITY_ITEMCLASSES = ['pollbook']  # itemclass substrings whose history is fetched first
+CACHE_PATH = '.cache/history_pages.sqlite3'  # On-disk cache of older observation pages
+CACHE_TTL_SECONDS = 24 * 60 * 60  # Older cached pages are revalidated with the API
+CACHE_MAX_BYTES = 500 * 1024 * 1024
+CACHE_MAX_AGE_SECONDS = 3 * CACHE_TTL_SECONDS  # Cached pages not used for this long are deleted
+PAGE_FANOUT = 10  # Max pages of one asset's history requested at once
+HISTORY_QUEUE_SIZE = 200  # Max pages of asset history waiting to be written
+HISTORY_BATCH_SIZE = 5_000  # Min rows of asset history written per transaction
+PRECINCT_CACHE_PATH = '.cache/precincts.json'  # Precinct of each (itemname, manufacturer, model) seen
+PRECINCT_CACHE_SIZE = 100_000
+PAYLOAD_FINGERPRINT_PATH = '.cache/assets_payload.json'  # Fingerprint of the Assets API response last fully processed
+ASSET_STREAM_CHUNK_BYTES = 64 * 1024  # Bytes of the Assets API response parsed at a time (--stream)
+ASSET_CHUNK_SIZE = 5_000  # Rows of assets prepared and copied to the temp table at a time (--stream)
+EXPORT_FETCH_SIZE = 2_000  # Rows of Assets fetched from the server-side cursor at a time for export
+STAGE_WORKERS = 4  # Pipeline stages of run.py run at once
+DAEMON_INTERVAL_SECONDS = 300  # Seconds between the starts of two runs with run.py --daemon
+DAEMON_ITERATION_TIMEOUT_SECONDS = 900  # A run still going after this long exits the process, for its supervisor to restart (--daemon)
+AIRFLOW_TIMEOUT_SECONDS = 60  # Max seconds to connect to, or wait for data from, the Airflow API
+SECRETS_TTL_SECONDS = 60 * 60  # Secrets are fetched again after this long (see secrets_cache.py)
+API_TOKEN_READY_SECONDS = 15  # Max seconds to wait for the API to accept a new token
+DB_POOL_SIZE = STAGE_WORKERS + 1  # Connections kept open: one per stage, plus the asset history writer
+DB_POOL_MAX_OVERFLOW = 2  # Extra connections opened when all of the pool is checked out
+DB_POOL_TIMEOUT_SECONDS = 30  # Max wait for a connection before raising
+DB_POOL_RECYCLE_SECONDS = 30 * 60  # Older connections are replaced on checkout (--daemon)
+ROUTER_SWAP_LOCK_TIMEOUT_MS = 5_000  # Max wait for readers of asset_router_locations when swapping in a rebuild
+ROUTER_SWAP_ATTEMPTS = 3
+ROUTER_SWAP_KEEP_OLD = False  # Keep the replaced table as asset_router_locations_old for rollback
+PLAN_SEQ_SCAN_ROWS = 10_000  # query_plans.py flags sequential scans of at least this many rows
+PLAN_SAMPLE_IDS = 100  # Recently updated asset ids that query_plans.py runs the statements for
+HISTORY_RETENTION_DAYS = 365  # Asset history older than this is not fetched, and its partitions are dropped
+HISTORY_PARTITIONS_AHEAD = 1  # Monthly partitions of asset_history created ahead of the current month
+HISTORY_DETACH_EXPIRED = False  # Detach expired asset_history partitions (kept as tables) rather than drop them
 API_UPDATE_FILE = 'api_update.json'
 
 SFTP_DIRECTORY = 'CCO_Asset_Management'
+SFTP_STATE_PATH = '.cache/sftp_published.json'  # Fingerprint of the last file uploaded to each path
 
 DAG_NAME_ASSETS = f'{SCHEMA}__assets'
 DAG_NAME_ASSET_ROUTER_LOCATIONS = f'{SCHEMA}__asset_router_locations'
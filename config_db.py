@@ -1,9 +1,49 @@
-import sqlalchemy as sa, logging
+import sqlalchemy as sa, logging, threading, time
 import config as conf
+import secrets_cache, db_indexes
+
+
+class MeteredQueuePool(sa.pool.QueuePool):
+    '''QueuePool that counts checkouts and how long each took, see pool_metrics()'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        with self._metrics_lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.peak_checked_out = 0
+
+    def _do_get(self):
+        # Includes the wait for a free connection and, if a new one is opened, the connect
+        start = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except sa.exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        wait = time.monotonic() - start
+        with self._metrics_lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+        return connection
+
+    def _create_connection(self):
+        with self._metrics_lock:
+            self.connects += 1
+        return super()._create_connection()
 
 
 def create_engine(creds: dict, test: bool, run_local: bool) -> sa.Engine:
-    '''Compose the URL object, create engine, and test connection'''
+    '''Compose the URL object, create engine with its connection pool, and test connection'''
     if run_local: 
         if test: 
             db_creds = creds[conf.DB_SECRET_LOCAL_TEST]
@@ -15,18 +55,73 @@ def create_engine(creds: dict, test: bool, run_local: bool) -> sa.Engine:
         db_creds = creds[conf.DB_SECRET_HOST]
     creds_schema = creds[conf.DB_SECRET_LOGIN]
     url_object = sa.URL.create(
-        drivername='postgresql+psycopg',
+        drivername='postgresql+psycopg2', # The driver of peewee, which shares this pool - see models.SharedPoolDatabase
         username=creds_schema['login'],
         password=creds_schema['password'],
         host=db_creds['host'],
         port=db_creds['port'],
-        database=db_creds['database']
+        database=db_creds['database'], 
+        query={'sslmode': 'require'}
+    )
+    engine = sa.create_engine(url_object, 
+        poolclass=MeteredQueuePool, 
+        pool_size=conf.DB_POOL_SIZE, 
+        max_overflow=conf.DB_POOL_MAX_OVERFLOW, 
+        pool_timeout=conf.DB_POOL_TIMEOUT_SECONDS, 
+        pool_recycle=conf.DB_POOL_RECYCLE_SECONDS, 
+        pool_pre_ping=True # Replace connections dropped by the server between runs
     )
-    engine = sa.create_engine(url_object)
-    engine.connect()
+    with engine.connect(): # Returned to the pool for the first caller
+        pass
     return engine
 
 
+def get_engine(test: bool, run_local: bool) -> sa.Engine: 
+    '''Return the engine for the test/production database, created on first use 
+    and then shared by every caller in this process (e.g. each run of `run.py --daemon`). 
+    Its pool is the only one in the process: the peewee models also check their 
+    connections out of it.'''
+    key = (test, run_local)
+    with _engines_lock: 
+        if key not in _engines: 
+            _engines[key] = secrets_cache.connect_with_secrets(create_engine, 
+                conf.DB_SECRET_HOST, conf.DB_SECRET_HOST_TEST, 
+                conf.DB_SECRET_LOCAL, conf.DB_SECRET_LOCAL_TEST, 
+                conf.DB_SECRET_LOGIN, 
+                test=test, run_local=run_local)
+        return _engines[key]
+
+
+def pool_metrics(engine: sa.Engine, reset: bool = False) -> dict: 
+    '''Return the checkout metrics of the engine's pool (see MeteredQueuePool)
+    - `reset`: Start counting again from zero, e.g. at the end of each run'''
+    pool = engine.pool
+    with pool._metrics_lock: 
+        metrics = {
+            'checkouts': pool.checkouts, 
+            'connects': pool.connects, 
+            'timeouts': pool.timeouts, 
+            'wait_seconds': pool.wait_seconds, 
+            'max_wait_seconds': pool.max_wait_seconds, 
+            'peak_checked_out': pool.peak_checked_out, 
+            'size': pool.size(), 
+            'checked_out': pool.checkedout()
+        }
+    if reset: 
+        pool.reset_metrics()
+    return metrics
+
+
+def pool_summary(engine: sa.Engine, reset: bool = False) -> str: 
+    '''One-line summary of pool_metrics() for the log'''
+    m = pool_metrics(engine, reset=reset)
+    mean_wait = m['wait_seconds'] / m['checkouts'] if m['checkouts'] else 0.0
+    return (f'Connection pool: {m["checkouts"]:,} checkouts, {m["connects"]:,} new connections, '
+            f'{mean_wait * 1000:,.1f}ms mean / {m["max_wait_seconds"] * 1000:,.1f}ms max checkout wait, '
+            f'{m["timeouts"]:,} timeouts, peak {m["peak_checked_out"]} of {m["size"]} '
+            f'(+{conf.DB_POOL_MAX_OVERFLOW} overflow) checked out')
+
+
 def setup_db_tables(engine: sa.Engine, metadata: sa.MetaData, drop: bool):
     '''Possibly drop and re-create tables in database'''
     if drop:
@@ -36,12 +131,38 @@ def setup_db_tables(engine: sa.Engine, metadata: sa.MetaData, drop: bool):
     metadata.create_all(bind=engine, checkfirst=True)
     logger.info(
         f'CREATE IF NOT EXISTS for tables {list(metadata.tables.keys())} executed\n')
+    # create_all() only creates the indexes of the tables it creates
+    db_indexes.ensure_indexes(engine, db_indexes.table_indexes(metadata.sorted_tables))
+
+
+def dependent_views(conn: sa.Connection, table: sa.Table) -> list[str]: 
+    '''Return the names of views that select from table'''
+    stmt = sa.text(
+        'SELECT DISTINCT v.oid::regclass::text FROM pg_depend d '
+        'JOIN pg_rewrite r ON r.oid = d.objid '
+        'JOIN pg_class v ON v.oid = r.ev_class '
+        'WHERE d.refobjid = CAST(:table AS regclass) AND v.oid <> d.refobjid')
+    return [row[0] for row in conn.execute(stmt, {'table': f'{table.schema}.{table.name}'})]
+
+
+def copy_grants(conn: sa.Connection, table: sa.Table, to_table: sa.Table): 
+    '''Grant each privilege on table to the same role on to_table'''
+    stmt = sa.text(
+        'SELECT grantee, privilege_type FROM information_schema.table_privileges '
+        'WHERE table_schema = :schema AND table_name = :name')
+    preparer = conn.dialect.identifier_preparer
+    for grantee, privilege in conn.execute(stmt, {'schema': table.schema, 'name': table.name}): 
+        role = grantee if grantee == 'PUBLIC' else preparer.quote_identifier(grantee)
+        conn.execute(sa.text(f'GRANT {privilege} ON {to_table.schema}.{to_table.name} TO {role}'))
 
 
 # Define connection and table info
 global logger
 logger = logging.getLogger('main')
 
+_engines = {}  # (test, run_local) -> engine, see get_engine()
+_engines_lock = threading.Lock()
+
 metadata = sa.MetaData()
 asset_router_locations = sa.Table(
     'asset_router_locations', metadata,
@@ -90,6 +211,18 @@ asset_router_locations = sa.Table(
     sa.Column("router_location_method", sa.String(255)) ,
     sa.Column("router_location_updated_at", sa.String(255)), 
     sa.Column("polling_places_placename", sa.String(255)), 
+    sa.Index("asset_router_locations_asset_id", "asset_id"), # Incremental updates by asset
+    sa.Index("asset_router_locations_asset_precinct", "asset_precinct"), # and by precinct
+    schema=conf.SCHEMA
+)
+
+# Fingerprint of the routers joined to each precinct when asset_router_locations 
+# was last updated, see run_asset_router_locations.main()
+asset_router_locations_state = sa.Table(
+    'asset_router_locations_state', metadata,
+    sa.Column("precinct", sa.String(255), primary_key=True),
+    sa.Column("fingerprint", sa.String(32), nullable=False), # md5 of its router_precincts and routers rows
+    sa.Column("updated_on", sa.TIMESTAMP(timezone=True)),
     schema=conf.SCHEMA
 )
 
@@ -105,5 +238,18 @@ asset_history_columns = [
 asset_history = sa.Table(
     'asset_history', metadata,
     *asset_history_columns,
+    sa.Index("asset_history_id_lastseentime", "id", "lastseentime"), # Deletes and watermarks by id
+    schema=conf.SCHEMA, 
+    postgresql_partition_by='RANGE (lastseentime)' # Monthly partitions, see history_partitions.py
+)
+
+asset_history_queue = sa.Table(
+    'asset_history_queue', metadata,
+    sa.Column("id", sa.String(255), primary_key=True),
+    sa.Column("status", sa.String(20), nullable=False), # pending, in_progress, done, or failed
+    sa.Column("attempts", sa.Integer(), nullable=False, server_default='0'),
+    sa.Column("last_error", sa.Text()),
+    sa.Column("enqueued_on", sa.TIMESTAMP(timezone=True)),
+    sa.Column("updated_on", sa.TIMESTAMP(timezone=True)),
     schema=conf.SCHEMA
 )
@@ -0,0 +1,67 @@
+from typing import Callable
+import logging, os, signal, threading, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+def _run_iteration(func: Callable[[], list], iteration: int):
+    '''Run one iteration, logging rather than raising its errors so the daemon keeps going'''
+    start = time.monotonic()
+    try:
+        failed = func()
+    except (Exception, SystemExit) as e: # sys.exit() is used for unrecoverable API errors
+        logger.error(f'Run {iteration} failed after {time.monotonic() - start:,.0f}s: {e!r}',
+                     exc_info=not isinstance(e, SystemExit))
+        return
+    if failed:
+        logger.error(f'Run {iteration} finished with stage(s) that did not succeed: {", ".join(failed)}')
+    logger.info(f'Run {iteration} finished in {time.monotonic() - start:,.0f}s\n')
+
+
+def run_forever(func: Callable[[], list], interval: float, timeout: float):
+    '''Call func every `interval` seconds (from the start of one call to the start
+    of the next) until SIGTERM or SIGINT
+    ```
+    run_forever(run_once, interval=300, timeout=900)
+    ```
+    The first signal lets the current call finish and then returns; a second one
+    stops immediately. Each call runs in its own thread: one still running after
+    `timeout` seconds is hung, and since calls share module state and the work
+    queue another cannot safely start alongside it, so the process exits with
+    status 1 for its supervisor (e.g. systemd) to restart. func returns the names
+    of any stages that did not succeed.
+    '''
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        logger.info(f'Received {signal.Signals(signum).name} - stopping after the current run '
+                    f'(send again to stop now)')
+        stop.set()
+
+    handlers = {signum: signal.signal(signum, request_stop)
+                for signum in (signal.SIGTERM, signal.SIGINT)}
+    logger.info(f'Daemon mode - running every {interval:,}s until SIGTERM/SIGINT\n')
+    iteration = 0
+    try:
+        while not stop.is_set():
+            iteration += 1
+            start = time.monotonic()
+            logger.info(f'{"=" * 80}')
+            logger.info(f'Starting run {iteration}\n')
+            thread = threading.Thread(target=_run_iteration, args=(func, iteration),
+                                      name=f'run-{iteration}', daemon=True)
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.critical(f'Run {iteration} still running after {timeout:,}s - exiting')
+                logging.shutdown()
+                os._exit(1) # Not sys.exit(), which would wait for the hung run's threads
+            stop.wait(max(0.0, interval - (time.monotonic() - start)))
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    logger.info('Daemon stopped\n')
@@ -1,10 +1,10 @@
-import requests, json, click
-from config import AIRFLOW_SECRET
+import requests, json, click, functools
+from config import AIRFLOW_SECRET, AIRFLOW_TIMEOUT_SECONDS
 from datetime import datetime, timezone, timedelta
 import urllib.parse
 from urllib3.util import Retry
 from requests.adapters import HTTPAdapter
-import citygeo_secrets
+import citygeo_secrets, secrets_cache
 
 
 def check_dag_runnable(creds: dict, dagname: str, session: requests.Session) -> bool:
@@ -48,7 +48,8 @@ def check_dag_runnable(creds: dict, dagname: str, session: requests.Session) ->
         headers=headers,
         data=json.dumps(body),
         auth=(login, password), 
-        verify=False
+        verify=False, 
+        timeout=AIRFLOW_TIMEOUT_SECONDS
     )
     result.raise_for_status()
     return_dict = result.json()
@@ -61,7 +62,8 @@ def check_dag_runnable(creds: dict, dagname: str, session: requests.Session) ->
         headers=headers,
         data=json.dumps(body),
         auth=(login, password), 
-        verify=False
+        verify=False, 
+        timeout=AIRFLOW_TIMEOUT_SECONDS
         )
     result.raise_for_status()
     return_dict = result.json()
@@ -118,7 +120,8 @@ def trigger_dag(creds: dict, dagname: str, session: requests.Session):
         headers=headers,
         data=json.dumps(body),
         auth=(login, password), 
-        verify=False
+        verify=False, 
+        timeout=AIRFLOW_TIMEOUT_SECONDS
         )
     if result.status_code != 200:
         print('Did not get a 200 response code back from the API!')
@@ -126,10 +129,10 @@ def trigger_dag(creds: dict, dagname: str, session: requests.Session):
     print("New dag_run_id: " + str(result.json()['dag_run_id']))
 
 
-def main(dagname: str): 
-    '''Trigger an airflow dag if the dag is runnable
-    - dagname: name of dag to trigger'''
-    citygeo_secrets.set_config(keeper_dir='~')
+@functools.cache
+def get_session() -> requests.Session: 
+    '''Return the session used for every DAG trigger in this process, so that its 
+    connection to Airflow is reused (e.g. across runs of `run.py --daemon`)'''
     s = requests.Session()
     retries = Retry(
         total=5,
@@ -138,8 +141,16 @@ def main(dagname: str):
         allowed_methods={'GET', 'POST'}
     )
     s.mount('https://', HTTPAdapter(max_retries=retries))
+    return s
+
+
+def main(dagname: str): 
+    '''Trigger an airflow dag if the dag is runnable
+    - dagname: name of dag to trigger'''
+    citygeo_secrets.set_config(keeper_dir='~')
+    s = get_session()
 
-    if citygeo_secrets.connect_with_secrets(check_dag_runnable, AIRFLOW_SECRET, 
-                                            dagname=dagname, session=s): 
-        citygeo_secrets.connect_with_secrets(trigger_dag, AIRFLOW_SECRET, 
-                                             dagname=dagname, session=s)
+    if secrets_cache.connect_with_secrets(check_dag_runnable, AIRFLOW_SECRET, 
+                                          dagname=dagname, session=s): 
+        secrets_cache.connect_with_secrets(trigger_dag, AIRFLOW_SECRET, 
+                                           dagname=dagname, session=s)
@@ -0,0 +1,92 @@
+import sqlalchemy as sa
+import config as conf
+from typing import Iterable, NamedTuple
+import logging
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class IndexSpec(NamedTuple):
+    '''A secondary index of a table'''
+    schema: str
+    table: str
+    name: str
+    columns: tuple[str, ...]
+    unique: bool = False
+
+
+# Indexes on tables of the routers project used by run_asset_router_locations.join_select()
+EXTERNAL_INDEXES = [
+    IndexSpec(conf.VIEWER_SCHEMA, 'router_precincts', 'router_precincts_precinct', ('precinct',)),
+    IndexSpec(conf.VIEWER_SCHEMA, 'routers', 'routers_id', ('id',)),
+]
+
+_failed = set()  # Indexes that could not be created, which are only warned about once per process
+
+
+def table_indexes(tables: Iterable[sa.Table]) -> list[IndexSpec]:
+    '''Return the indexes declared on SQLAlchemy tables'''
+    return [IndexSpec(table.schema, table.name, index.name,
+                      tuple(column.name for column in index.columns), index.unique)
+            for table in tables for index in sorted(table.indexes, key=lambda index: index.name)]
+
+
+def model_indexes(model) -> list[IndexSpec]:
+    '''Return the indexes declared on a peewee model, by its fields (index=True) or Meta.indexes'''
+    return [IndexSpec(model._meta.schema, model._meta.table_name, index._name,
+                      tuple(field.column_name for field in index._expressions), index._unique)
+            for index in model._meta.fields_to_index()]
+
+
+def create_index_sql(index: IndexSpec, concurrently: bool = True) -> str:
+    return (f'CREATE {"UNIQUE " if index.unique else ""}INDEX '
+            f'{"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS {index.name} '
+            f'ON {index.schema}.{index.table} ({", ".join(index.columns)})')
+
+
+def ensure_indexes(engine: sa.Engine, indexes: Iterable[IndexSpec]) -> int:
+    '''Create any of the indexes missing from existing tables, returning the number created
+
+    Indexes are built with CREATE INDEX CONCURRENTLY, so the pipeline's writes to
+    a table are not blocked while its index is built - except on partitioned
+    tables, where Postgres does not support it. A concurrent build that was
+    interrupted leaves an invalid index, which is dropped and built again. Tables
+    that do not exist yet are skipped: they get their indexes when created.
+    An index that cannot be built (e.g. on a table owned by another project) is
+    logged as a warning rather than raised.'''
+    created = 0
+    # CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for index in indexes:
+            if index in _failed:
+                continue
+            valid = conn.execute(sa.text(
+                'SELECT i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'WHERE n.nspname = :schema AND c.relname = :name'),
+                {'schema': index.schema, 'name': index.name}).scalar()
+            if valid == True:
+                continue
+            table = f'{index.schema}.{index.table}'
+            relkind = conn.execute(sa.text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)'),
+                                   {'table': table}).scalar()
+            if relkind == None:
+                continue
+            concurrently = relkind != 'p' # Not supported on partitioned tables
+            try:
+                if valid == False:
+                    logger.warning(f'Index {index.name} was left invalid by an interrupted build - rebuilding it')
+                    conn.execute(sa.text(f'DROP INDEX {"CONCURRENTLY " if concurrently else ""}'
+                                         f'IF EXISTS {index.schema}.{index.name}'))
+                logger.info(f'Creating index {index.name} on {table} ({", ".join(index.columns)})...')
+                conn.execute(sa.text(create_index_sql(index, concurrently)))
+                created += 1
+            except sa.exc.DBAPIError as e:
+                _failed.add(index)
+                logger.warning(f'Could not create index {index.name} on {table}: {e.orig!r}')
+    if created > 0:
+        logger.info(f'Created {created:,} indexes\n')
+    return created
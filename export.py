@@ -0,0 +1,130 @@
+import playhouse.postgres_ext as pwp
+import config as conf
+from models import Asset
+from typing import Sequence
+import csv, gzip, hashlib, logging, os
+
+
+global logger
+logger = logging.getLogger('main')
+
+FORMATS = ('xlsx', 'csv.gz', 'parquet')
+EXCLUDED_FIELDS = ['content_hash']  # Internal to change detection - see run_assets.upsert()
+
+
+def export_fields() -> list[pwp.Field]:
+    '''Fields of Assets included in the export, in table order'''
+    return [field for field in Asset._meta.sorted_fields if field.name not in EXCLUDED_FIELDS]
+
+
+def export_query() -> str:
+    '''SELECT of the exported fields by id, with timestamps converted to naive
+    US/Eastern in SQL (Excel cannot store a timezone)'''
+    columns = []
+    for field in export_fields():
+        if isinstance(field, pwp.DateTimeTZField):
+            columns.append(f"{field.column_name} AT TIME ZONE 'US/Eastern' AS {field.column_name}")
+        else:
+            columns.append(field.column_name)
+    # Ordered so that an unchanged table gives the same rows and fingerprint
+    return (f'SELECT {", ".join(columns)} FROM {Asset._meta.schema}.{Asset._meta.table_name} '
+            f'ORDER BY {Asset.id.column_name}')
+
+
+def export_path(format: str, file_name: str = conf.FILE_NAME) -> str:
+    '''Path of the export in a format, e.g. "asset_data.csv.gz" for "asset_data.xlsx"'''
+    return f'{os.path.splitext(file_name)[0]}.{format}'
+
+
+class _XlsxWriter():
+    '''Rows are streamed to a temporary file by openpyxl's write-only mode'''
+    def __init__(self, path: str, columns: Sequence[str]):
+        import openpyxl
+        self.path = path
+        self._workbook = openpyxl.Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet('Sheet1')
+        self._sheet.append(list(columns))
+
+    def write(self, rows: Sequence[tuple]):
+        for row in rows:
+            self._sheet.append(row)
+
+    def close(self):
+        self._workbook.save(self.path)
+
+
+class _CsvGzWriter():
+    def __init__(self, path: str, columns: Sequence[str]):
+        self.path = path
+        self._file = gzip.open(path, 'wt', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows: Sequence[tuple]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter():
+    '''Each batch of rows becomes a row group. Requires pyarrow, which is not in
+    requirements.txt because only this optional format uses it.'''
+    def __init__(self, path: str, columns: Sequence[str]):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('Exporting to parquet requires pyarrow - pip install pyarrow') from e
+        self.path = path
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            (field.column_name,
+             pyarrow.timestamp('us') if isinstance(field, pwp.DateTimeTZField) else pyarrow.string())
+            for field in export_fields()])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, rows: Sequence[tuple]):
+        arrays = [self._pa.array(values, type=column.type)
+                  for values, column in zip(zip(*rows), self._schema)]
+        self._writer.write_batch(self._pa.record_batch(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+_WRITERS = {'xlsx': _XlsxWriter, 'csv.gz': _CsvGzWriter, 'parquet': _ParquetWriter}
+
+
+def export_assets(database: pwp.PostgresqlExtDatabase, formats: Sequence[str] = ('xlsx',),
+                  file_name: str = conf.FILE_NAME) -> dict[str, str]:
+    '''Stream the Assets table into a file in each format, returning the path of
+    each file -> fingerprint of its content
+
+    Rows are read from a server-side (named) cursor `conf.EXPORT_FETCH_SIZE` at a time
+    and written to every file as they arrive, so memory use does not grow with the table.
+    The fingerprint is a hash of the rows and format rather than of the file, whose
+    bytes also hold the time it was written.
+    #### Parameters
+    - `database`: Initialized peewee database
+    - `formats`: Any of FORMATS
+    - `file_name`: Name of the xlsx file; other formats replace its extension'''
+    columns = [field.column_name for field in export_fields()]
+    writers = [_WRITERS[format](export_path(format, file_name), columns) for format in formats]
+    digest = hashlib.sha256(repr(columns).encode())
+    count = 0
+    try:
+        # The connection is in autocommit mode, where psycopg2 only allows a named
+        # cursor declared WITH HOLD, which outlives the statement's own transaction
+        with database.connection().cursor(name='asset_export', withhold=True) as cursor:
+            cursor.itersize = conf.EXPORT_FETCH_SIZE
+            cursor.execute(export_query())
+            while rows := cursor.fetchmany(conf.EXPORT_FETCH_SIZE):
+                for writer in writers:
+                    writer.write(rows)
+                digest.update(repr(rows).encode())
+                count += len(rows)
+    finally:
+        for writer in writers:
+            writer.close()
+    logger.info(f'Exported {count:,} records to {", ".join(writer.path for writer in writers)}\n')
+    return {writer.path: f'{format}:{digest.hexdigest()}' for format, writer in zip(formats, writers)}
@@ -0,0 +1,140 @@
+import sqlalchemy as sa
+import config as conf
+from config_db import asset_history, asset_history_columns, copy_grants, dependent_views
+import datetime as dt, zoneinfo, logging, re
+
+
+global logger
+logger = logging.getLogger('main')
+
+TIMEZONE = zoneinfo.ZoneInfo('US/Eastern')  # Months start at midnight Eastern
+DEFAULT_PARTITION = f'{asset_history.name}_default'  # Rows without a lastseentime or outside every month
+UNPARTITIONED = f'{asset_history.name}_unpartitioned'  # asset_history while it is migrated
+NAME_PATTERN = re.compile(rf'{asset_history.name}_y(\d{{4}})m(\d{{2}})')
+
+
+def month_start(timestamp: dt.datetime) -> dt.datetime:
+    '''Start of the month of timestamp'''
+    local = timestamp.astimezone(TIMEZONE)
+    return dt.datetime(local.year, local.month, 1, tzinfo=TIMEZONE)
+
+
+def next_month(start: dt.datetime) -> dt.datetime:
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def partition_name(start: dt.datetime) -> str:
+    '''Name of the partition of a month, e.g. "asset_history_y2026m10"'''
+    return f'{asset_history.name}_y{start.year}m{start.month:02}'
+
+
+def qualified(name: str) -> str:
+    return f'{asset_history.schema}.{name}'
+
+
+def get_relkind(conn: sa.Connection) -> str | None:
+    '''Return "p" if asset_history is partitioned, "r" if it is a plain table, or None if missing'''
+    return conn.execute(sa.text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)'),
+                        {'table': qualified(asset_history.name)}).scalar()
+
+
+def monthly_partitions(conn: sa.Connection) -> dict[str, dt.datetime]:
+    '''Return the name -> month start of each monthly partition of asset_history'''
+    stmt = sa.text('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = CAST(:table AS regclass)')
+    partitions = {}
+    for (name,) in conn.execute(stmt, {'table': qualified(asset_history.name)}):
+        if match := NAME_PATTERN.fullmatch(name):
+            partitions[name] = dt.datetime(int(match[1]), int(match[2]), 1, tzinfo=TIMEZONE)
+    return partitions
+
+
+def create_partition(conn: sa.Connection, start: dt.datetime):
+    '''Create the partition of the month starting at start
+
+    Postgres refuses a new partition while rows of its range are in the default
+    partition, so any such rows are moved into the new partition.'''
+    end = next_month(start)
+    bounds = {'start': start, 'end': end}
+    in_default = (f'FROM {qualified(DEFAULT_PARTITION)} '
+                  f'WHERE lastseentime >= :start AND lastseentime < :end')
+    moved = conn.execute(sa.text(
+        f'CREATE TEMPORARY TABLE asset_history_moved AS SELECT * {in_default}'), bounds).rowcount
+    conn.execute(sa.text(f'DELETE {in_default}'), bounds)
+    conn.execute(sa.text(
+        f'CREATE TABLE {qualified(partition_name(start))} PARTITION OF {qualified(asset_history.name)} '
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"))
+    conn.execute(sa.text(f'INSERT INTO {qualified(asset_history.name)} SELECT * FROM asset_history_moved'))
+    conn.execute(sa.text('DROP TABLE asset_history_moved'))
+    logger.info(f'Created partition {partition_name(start)}'
+                + (f', moving {moved:,} rows from {DEFAULT_PARTITION}' if moved else ''))
+
+
+def maintain(engine: sa.Engine):
+    '''Keep asset_history partitioned by month of lastseentime
+
+    Creates the monthly partitions from the retention cutoff (HISTORY_RETENTION_DAYS
+    ago) to HISTORY_PARTITIONS_AHEAD months from now, plus a default partition, and
+    drops - or with HISTORY_DETACH_EXPIRED detaches - each partition wholly older
+    than the cutoff. Rows in the default partition from before the month of the
+    cutoff - the rest of a page that crosses it, or rows of a month whose partition
+    was already dropped - are deleted, so they are also kept no longer than the
+    retention period. A plain asset_history table from before partitioning is
+    migrated: its rows within the retention period are copied into the new
+    partitioned table, in one transaction, and the plain table is dropped.'''
+    now = dt.datetime.now(tz=TIMEZONE)
+    cutoff = now - dt.timedelta(days=conf.HISTORY_RETENTION_DAYS)
+    with engine.begin() as conn:
+        relkind = get_relkind(conn)
+        if relkind == None: # Created by setup_db_tables() before any history is written
+            return
+        migrate = relkind != 'p'
+        if migrate:
+            views = dependent_views(conn, asset_history)
+            if views: # A view would follow the renamed table and block dropping it
+                logger.warning(f'Not partitioning asset_history because views {views} select from it - '
+                               f'drop them and rebuild them (e.g. with dbt) after the next run')
+                return
+            logger.info(f'Migrating asset_history to a table partitioned by month...\n')
+            conn.execute(sa.text(f'ALTER TABLE {qualified(asset_history.name)} RENAME TO {UNPARTITIONED}'))
+            for index in asset_history.indexes:
+                conn.execute(sa.text(f'ALTER INDEX IF EXISTS {qualified(index.name)} '
+                                     f'RENAME TO {index.name}_unpartitioned'))
+            asset_history.create(conn)
+            copy_grants(conn, sa.table(UNPARTITIONED, schema=asset_history.schema), asset_history)
+
+        conn.execute(sa.text(f'CREATE TABLE IF NOT EXISTS {qualified(DEFAULT_PARTITION)} '
+                             f'PARTITION OF {qualified(asset_history.name)} DEFAULT'))
+        partitions = monthly_partitions(conn)
+        start, last = month_start(cutoff), month_start(now)
+        for _ in range(conf.HISTORY_PARTITIONS_AHEAD):
+            last = next_month(last)
+        while start <= last:
+            if partition_name(start) not in partitions:
+                create_partition(conn, start)
+            start = next_month(start)
+
+        if migrate:
+            columns = ', '.join(column.name for column in asset_history_columns)
+            result = conn.execute(sa.text(
+                f'INSERT INTO {qualified(asset_history.name)} ({columns}) '
+                f'SELECT {columns} FROM {qualified(UNPARTITIONED)} '
+                f'WHERE lastseentime >= :start OR lastseentime IS NULL'), {'start': month_start(cutoff)})
+            conn.execute(sa.text(f'DROP TABLE {qualified(UNPARTITIONED)}'))
+            logger.info(f'Copied {result.rowcount:,} rows within the retention period into '
+                        f'the partitioned asset_history\n')
+
+        for name, month in sorted(partitions.items(), key=lambda item: item[1]):
+            if next_month(month) > cutoff:
+                continue
+            if conf.HISTORY_DETACH_EXPIRED:
+                conn.execute(sa.text(f'ALTER TABLE {qualified(asset_history.name)} DETACH PARTITION {qualified(name)}'))
+                logger.info(f'Detached expired partition {name}')
+            else:
+                conn.execute(sa.text(f'DROP TABLE {qualified(name)}'))
+                logger.info(f'Dropped expired partition {name}')
+
+        expired = conn.execute(sa.text(f'DELETE FROM {qualified(DEFAULT_PARTITION)} WHERE lastseentime < :start'),
+                               {'start': month_start(cutoff)}).rowcount
+        if expired:
+            logger.info(f'Deleted {expired:,} expired rows from {DEFAULT_PARTITION}')
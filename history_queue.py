@@ -0,0 +1,138 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import config as conf
+from config_db import asset_history_queue
+from typing import Sequence
+import datetime as dt, zoneinfo, logging
+
+
+global logger
+logger = logging.getLogger('main')
+
+PENDING, IN_PROGRESS, DONE, FAILED = 'pending', 'in_progress', 'done', 'failed'
+
+# Only the columns of Assets needed to prioritize the work queue
+assets = sa.table('assets', sa.column('id'), sa.column('itemclass'), sa.column('lastseentime'),
+                  schema=conf.SCHEMA)
+
+
+def now() -> dt.datetime:
+    '''Current time in US/Eastern'''
+    return dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
+
+
+def enqueue_statement(ids: Sequence[str]):
+    '''Return the INSERT that adds ids to the asset history work queue as pending,
+    resetting their attempts if already queued, or None if there are no ids'''
+    if len(ids) == 0:
+        return None
+    timestamp = now()
+    stmt = postgresql.insert(asset_history_queue).values(
+        [{'id': id, 'status': PENDING, 'attempts': 0,
+          'enqueued_on': timestamp, 'updated_on': timestamp} for id in ids])
+    return stmt.on_conflict_do_update(
+        index_elements=[asset_history_queue.c.id],
+        set_={'status': PENDING, 'attempts': 0, 'last_error': None,
+              'enqueued_on': timestamp, 'updated_on': timestamp})
+
+
+def claimable():
+    '''Condition for ids that a run should process: pending, left in progress by a
+    run that was killed, or failed with attempts remaining'''
+    q = asset_history_queue.c
+    return sa.and_(q.status.in_([PENDING, IN_PROGRESS, FAILED]),
+                   q.attempts < conf.HISTORY_QUEUE_MAX_ATTEMPTS)
+
+
+def priority_order() -> list:
+    '''ORDER BY clauses for the work queue, highest priority first: 
+    1. itemclass in config.HISTORY_PRIORITY_ITEMCLASSES (e.g. pollbooks)
+    2. Longest since last refreshed, i.e. enqueued or deferred the longest
+    3. Most recently seen assets'''
+    q = asset_history_queue.c
+    priority_class = sa.or_(sa.false(), *[
+        assets.c.itemclass.ilike(f'%{itemclass}%') for itemclass in conf.HISTORY_PRIORITY_ITEMCLASSES])
+    return [
+        sa.case((priority_class, 0), else_=1),
+        q.enqueued_on.asc().nulls_first(),
+        assets.c.lastseentime.desc().nulls_last(),
+    ]
+
+
+def claim(conn: sa.Connection) -> list[str]:
+    '''Mark every claimable id as in progress, incrementing its attempts, and
+    return those ids in priority order (see priority_order())
+
+    One UPDATE ... RETURNING both claims and returns the ids, so an id enqueued
+    meanwhile is either claimed and returned or left pending for the next run.'''
+    q = asset_history_queue.c
+    ranked = (sa
+              .select(q.id, sa.func.row_number().over(order_by=priority_order()).label('rank'))
+              .select_from(asset_history_queue.outerjoin(assets, assets.c.id == q.id))
+              .where(claimable())
+              .subquery('ranked'))
+    stmt = (sa
+            .update(asset_history_queue)
+            .where(q.id == ranked.c.id, claimable())
+            .values(status=IN_PROGRESS, attempts=q.attempts + 1, updated_on=now())
+            .returning(q.id, ranked.c.rank))
+    ids = [id for id, rank in sorted(conn.execute(stmt), key=lambda row: row[1])]
+    logger.info(f'Claimed {len(ids):,} IDs from the asset history work queue')
+    exhausted = conn.execute(
+        sa.select(sa.func.count())
+        .select_from(asset_history_queue)
+        .where(q.status == FAILED, q.attempts >= conf.HISTORY_QUEUE_MAX_ATTEMPTS)
+    ).scalar()
+    if exhausted > 0:
+        logger.warning(f'{exhausted:,} IDs failed {conf.HISTORY_QUEUE_MAX_ATTEMPTS} times '
+                       f'and are no longer claimed until enqueued again')
+    return ids
+
+
+def mark_done(conn: sa.Connection, ids: Sequence[str]):
+    '''Mark ids whose history has been written as done'''
+    if len(ids) == 0:
+        return
+    stmt = (sa
+            .update(asset_history_queue)
+            .where(asset_history_queue.c.id.in_(ids))
+            .values(status=DONE, last_error=None, updated_on=now()))
+    conn.execute(stmt)
+
+
+def mark_failed(conn: sa.Connection, errors: dict):
+    '''Mark ids as failed with their error message, so that a later run retries them
+    - `errors`: Dict of id -> error message'''
+    timestamp = now()
+    for id, error in errors.items():
+        stmt = (sa
+                .update(asset_history_queue)
+                .where(asset_history_queue.c.id == id)
+                .values(status=FAILED, last_error=str(error)[:1000], updated_on=timestamp))
+        conn.execute(stmt)
+
+
+def defer(conn: sa.Connection, ids: Sequence[str]):
+    '''Return claimed ids that were not started to pending without using an attempt'''
+    if len(ids) == 0:
+        return
+    q = asset_history_queue.c
+    stmt = (sa
+            .update(asset_history_queue)
+            .where(q.id.in_(ids))
+            .values(status=PENDING, attempts=q.attempts - 1, updated_on=now()))
+    conn.execute(stmt)
+    logger.info(f'Deferred {len(ids):,} IDs to the next run\n')
+
+
+def count_claimable(conn: sa.Connection) -> int:
+    '''Return the number of ids that the next run would claim'''
+    stmt = sa.select(sa.func.count()).select_from(asset_history_queue).where(claimable())
+    return conn.execute(stmt).scalar()
+
+
+def count_by_status(conn: sa.Connection) -> dict:
+    '''Return the number of queued ids in each status'''
+    q = asset_history_queue.c
+    stmt = sa.select(q.status, sa.func.count()).group_by(q.status)
+    return {status: count for status, count in conn.execute(stmt)}
@@ -0,0 +1,153 @@
+import sqlalchemy as sa
+import config as conf, bulk_load, history_queue
+from config_db import asset_history
+import datetime as dt, logging, queue, threading
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+COLUMNS = [c.name for c in asset_history.columns]
+
+
+def page_columns(id: str, data: list[dict], updated_on: dt.datetime) -> dict[str, list]:
+    '''Convert one page of observations into column buffers of asset_history
+    
+    The API's keys (e.g. "lastSeenTime") are mapped to column names once per page 
+    rather than once per row; "id" and "updated_on" are added.'''
+    n = len(data)
+    columns = {'id': [id] * n, 'updated_on': [updated_on] * n}
+    keys = {k.lower(): k for k in data[0]} if n > 0 else {}
+    for column in COLUMNS:
+        if column in columns:
+            continue
+        key = keys.get(column)
+        columns[column] = [row.get(key) for row in data] if key != None else [None] * n
+    return columns
+
+
+def extend_columns(target: dict[str, list], source: dict[str, list]):
+    '''Append column buffers to another set of column buffers'''
+    for column, values in source.items():
+        target.setdefault(column, []).extend(values)
+
+
+class HistoryWriter(threading.Thread):
+    '''Drain pages of normalized observations from a bounded queue into asset_history
+    in batches while the fetch workers continue
+    ```
+    writer = HistoryWriter(engine, incremental=False)
+    writer.start()
+    writer.put(id, columns)              # One or more pages per id, from any thread
+    writer.put(id, columns, final=True)  # Last page of that id
+    writer.fail(id, error)               # Or, if getting that id's history failed
+    writer.close()                       # Flush remaining ids and raise any error
+    ```
+    Pages are column buffers from page_columns(), accumulated per batch and 
+    passed to the bulk loader as they are - the API's ISO 8601 timestamp strings
+    are parsed by Postgres during the COPY. An id is written only after its final
+    page is received. Unless in incremental mode, each id's existing rows are
+    deleted in the same transaction that inserts its new rows, so the
+    delete-then-insert of each id stays atomic. The same
+    transaction marks the ids as done (or failed) in the asset history work queue.
+    '''
+    _done = object()
+
+    def __init__(self, engine: sa.Engine, incremental: bool,
+                 batch_size: int = conf.HISTORY_BATCH_SIZE,
+                 queue_size: int = conf.HISTORY_QUEUE_SIZE):
+        super().__init__(name='HistoryWriter', daemon=True)
+        self.engine = engine
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rows_written = 0
+        self.ids_written = 0
+        self.rows_deleted = 0
+        self.ids_failed = 0
+        self.error = None
+        self._pending = {}  # id -> column buffers of pages received so far
+        self._batch_ids = []
+        self._batch = {}  # Column buffers of the completed ids
+        self._batch_count = 0
+        self._batch_failed = {}  # id -> error
+
+    def put(self, id: str, columns: dict[str, list], final: bool = False):
+        '''Add one page of column buffers for an id, blocking while the queue is full'''
+        self.queue.put((id, columns, final, None))
+
+    def fail(self, id: str, error: Exception):
+        '''Discard any pages of an id whose history could not be fetched and mark it
+        as failed in the work queue'''
+        self.queue.put((id, None, True, error))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._done:
+                break
+            if self.error != None: # Keep draining so that producers never block
+                continue
+            try:
+                self._receive(*item)
+            except Exception as e:
+                self.error = e
+        if self.error == None:
+            try:
+                self._flush()
+            except Exception as e:
+                self.error = e
+
+    def _receive(self, id: str, columns: dict[str, list], final: bool, error: Exception):
+        if error != None:
+            self._pending.pop(id, None)
+            self._batch_failed[id] = error
+            return
+        extend_columns(self._pending.setdefault(id, {}), columns)
+        if final:
+            pending = self._pending.pop(id)
+            self._batch_ids.append(id)
+            self._batch_count += len(pending.get('id', []))
+            extend_columns(self._batch, pending)
+            if self._batch_count >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        '''Write the completed ids in one transaction'''
+        if self._batch_ids == [] and self._batch_failed == {}:
+            return
+        with self.engine.begin() as conn:
+            if not self.incremental:
+                stmt_delete = (sa
+                               .delete(asset_history)
+                               .where(asset_history.c.id.in_(self._batch_ids)))
+                result = conn.execute(stmt_delete)
+                self.rows_deleted += result.rowcount
+            if self._batch_count > 0:
+                bulk_load.copy_columns(conn, asset_history, self._batch)
+            history_queue.mark_done(conn, self._batch_ids)
+            history_queue.mark_failed(conn, self._batch_failed)
+        self.rows_written += self._batch_count
+        self.ids_written += len(self._batch_ids)
+        self.ids_failed += len(self._batch_failed)
+        logger.debug(f'HistoryWriter wrote {self._batch_count:,} rows for '
+                     f'{len(self._batch_ids):,} IDs')
+        self._batch_ids = []
+        self._batch = {}
+        self._batch_count = 0
+        self._batch_failed = {}
+
+    def close(self):
+        '''Wait for all queued pages to be written, then raise any error that occurred'''
+        self.queue.put(self._done)
+        self.join()
+        if self.error != None:
+            raise self.error
+        if self._pending != {}:
+            logger.warning(f'{len(self._pending):,} IDs did not receive a final page and were not written')
+        logger.info(f'Deleted {self.rows_deleted:,} and inserted {self.rows_written:,} '
+                    f'asset_history rows for {self.ids_written:,} IDs\n')
+        if self.ids_failed > 0:
+            logger.error(f'Failed to get the history of {self.ids_failed:,} IDs; '
+                         f'they remain in the work queue for the next run\n')
@@ -0,0 +1,106 @@
+from typing import Iterable, Iterator
+import codecs, json
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class JsonArrayStream():
+    '''Iterate over the items of one array in a top-level JSON object while the
+    document arrives in chunks, so that the whole document is never in memory
+    ```
+    stream = JsonArrayStream(response.iter_content(64 * 1024), key='data')
+    for item in stream:
+        # process one item
+    stream.metadata  # The object's other keys, complete once iteration finishes
+    ```
+    Each item is decoded with the standard library's json decoder once it has fully
+    arrived; only the current item and the unparsed remainder of a chunk are buffered.
+    - `chunks`: Iterable of bytes (UTF-8) or str
+    - `key`: Key of the array in the top-level object
+    '''
+    def __init__(self, chunks: Iterable[bytes | str], key: str):
+        self.key = key
+        self.metadata = {}
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self) -> bool:
+        '''Append the next chunk to the buffer, dropping what was already parsed.
+        Returns False if the document has ended.'''
+        if self._eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            text = self._utf8.decode(b'', final=True)
+        else:
+            text = self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        '''Skip whitespace and return the next character without consuming it, or '' at the end'''
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        '''Consume and return the next character, which must be one of chars'''
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise json.JSONDecodeError(
+                f'Expected one of {chars!r}, found {char or "end of document"!r}',
+                self._buffer, self._pos)
+        self._pos += 1
+        return char
+
+    def _value(self):
+        '''Decode the next complete JSON value, reading more chunks until it has arrived'''
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end < len(self._buffer) or not self._read():
+                self._pos = end
+                return value
+
+    def _items(self) -> Iterator:
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self) -> Iterator:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            name = self._value()
+            self._expect(':')
+            if name == self.key:
+                yield from self._items()
+            else:
+                self.metadata[name] = self._value()
+            if self._expect(',}') == '}':
+                return
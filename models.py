@@ -1,30 +1,33 @@
 import config
 import playhouse.postgres_ext as pwp # Extension to peewee module
+import sqlalchemy as sa
 
 
-def init_db(creds: dict, test: bool, run_local: bool, database: pwp.PostgresqlExtDatabase) -> pwp.PostgresqlExtDatabase: 
-    '''Initialize and return the database at run-time'''
-    schema_creds = creds[config.DB_SECRET_LOGIN]
-    if run_local: 
-        if test: 
-            db_creds = creds[config.DB_SECRET_LOCAL_TEST]
-        else: 
-            db_creds = creds[config.DB_SECRET_LOCAL]
-    elif test: 
-        db_creds = creds[config.DB_SECRET_HOST_TEST]
-    else: 
-        db_creds = creds[config.DB_SECRET_HOST]
-    database.init(
-        database=db_creds['database'],
-        user=schema_creds['login'],
-        password=schema_creds['password'],
-        host=db_creds['host'],
-        port=db_creds['port'], 
-        sslmode='require'
-    )
+class SharedPoolDatabase(pwp.PostgresqlExtDatabase): 
+    '''peewee database that checks its connections out of the pool of a SQLAlchemy 
+    engine (see config_db.get_engine()) rather than opening its own, so the whole 
+    process shares one pool. Closing a connection returns it to the pool.'''
+    def init(self, engine: sa.Engine, **kwargs): 
+        self.engine = engine
+        super().init(engine.url.database if engine != None else None, **kwargs)
+
+    def _connect(self): 
+        conn = self.engine.raw_connection()
+        conn.rollback() # The pool may have left a transaction open, e.g. after its pre-ping
+        conn.driver_connection.autocommit = True # As peewee sets on its own connections
+        return conn
+
+    def _close(self, conn): 
+        conn.driver_connection.autocommit = False # As SQLAlchemy expects on its connections
+        conn.close()
+
+
+def init_db(engine: sa.Engine, database: SharedPoolDatabase) -> SharedPoolDatabase: 
+    '''Initialize and return the database at run-time, on the shared connection pool of engine'''
+    database.init(engine)
     return database
 
-blank_db = pwp.PostgresqlExtDatabase(None) # Defer initialization of database until run-time - see run.py
+blank_db = SharedPoolDatabase(None) # Defer initialization of database until run-time - see run.py
 
 class BaseModel(pwp.Model):
     itemname = pwp.CharField(null=True)
@@ -42,6 +45,7 @@ class BaseModel(pwp.Model):
     # totalcount = pwp.IntegerField(null=True) # No longer in use in order to not send every ID to run_asset_history.py when one asset is added and this count changes
     updated_on = pwp.DateTimeTZField(null=False)
     precinct = pwp.CharField(max_length=5, null=True)  # CityGeo added
+    content_hash = pwp.CharField(max_length=16, null=True, index=True)  # CityGeo added - see run_assets.add_content_hash()
 
     class Meta:
         database = blank_db
@@ -51,8 +55,16 @@ class Asset(BaseModel):
     class Meta:
         schema = config.SCHEMA
         table_name = 'assets'
+        indexes = ((('precinct',), False),)  # Joined to router_precincts, see run_asset_router_locations.py
 
 
 class Asset_Temp(BaseModel):
     class Meta:
         table_name = 'assets_temp'
+
+
+def migrate_db(database: pwp.PostgresqlExtDatabase): 
+    '''Add columns to an Assets table created before they were defined. Run before 
+    Asset.create_table(safe=True), which then creates any missing indexes.'''
+    table = f'{Asset._meta.schema}.{Asset._meta.table_name}'
+    database.execute_sql(f'ALTER TABLE IF EXISTS {table} ADD COLUMN IF NOT EXISTS content_hash VARCHAR(16)')
@@ -0,0 +1,49 @@
+import config as conf
+import hashlib, json, logging, os
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+def fingerprint(payload: bytes) -> str:
+    '''Fingerprint of the raw body of an Assets API response'''
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def target(test: bool, run_local: bool) -> str:
+    '''Name of the database a run writes to, which each keeps its own fingerprint'''
+    return f'{"local" if run_local else "host"}-{"test" if test else "production"}'
+
+
+def _load(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.warning(f'Ignoring unreadable payload fingerprints {path}: {e!r}')
+        return {}
+
+
+def last_processed(target: str, path: str = conf.PAYLOAD_FINGERPRINT_PATH) -> str | None:
+    '''Return the fingerprint of the payload last fully processed into target, if any'''
+    return _load(path).get(target)
+
+
+def record(target: str, fingerprint: str | None, path: str = conf.PAYLOAD_FINGERPRINT_PATH):
+    '''Save the fingerprint of the payload fully processed into target, or with None
+    forget it, e.g. before a different payload starts to change the database'''
+    fingerprints = _load(path)
+    if fingerprints.get(target) == fingerprint:
+        return
+    if fingerprint == None:
+        fingerprints.pop(target, None)
+    else:
+        fingerprints[target] = fingerprint
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(fingerprints, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,109 @@
+import pandas as pd
+import config as conf
+from typing import Sequence
+import collections, json, logging, os
+
+
+global logger
+logger = logging.getLogger('main')
+
+KEY_FIELDS = ['itemname', 'manufacturer', 'model']
+
+# One pass over "itemname \0 manufacturer \0 model" in the following priority:
+# 1. The 1st ward-division (e.g. "12-3") in itemname
+# 2. Otherwise the 1st number in manufacturer as the ward and/or in model as the division
+PATTERN = (
+    r'(?:[^\0]*?(?P<ward>\d{1,2})\s*-\s*(?P<division>\d{1,2})[^\0]*|[^\0]*)\0'
+    r'(?:[^\0]*?(?P<manufacturer_ward>\d{1,2})[^\0]*|[^\0]*)\0'
+    r'(?:[^\0]*?(?P<model_division>\d{1,2})[^\0]*|[^\0]*)'
+)
+
+
+class PrecinctExtractor():
+    '''Extract the precinct ("WW-DD") of each asset, memoizing the result for each
+    (itemname, manufacturer, model) in an LRU cache that is persisted across runs
+    ```
+    precincts = PrecinctExtractor()
+    df['precinct'] = precincts.extract(df)  # Repeat for each chunk of assets
+    precincts.save()
+    logger.info(precincts.summary())
+    ```
+    Only combinations not seen before are parsed, all at once with PATTERN.
+    - `path`: JSON file the cache is loaded from and saved to
+    - `max_size`: Max combinations kept, least recently used evicted first
+    '''
+    def __init__(self, path: str = conf.PRECINCT_CACHE_PATH, max_size: int = conf.PRECINCT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'unparsed': 0}
+        self._cache = collections.OrderedDict()
+        self._changed = False
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            if stored['pattern'] == PATTERN: # Otherwise stale - parse everything again
+                for *key, precinct in stored['precincts']:
+                    self._cache[tuple(key)] = precinct
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f'Ignoring unreadable precinct cache {path}: {e!r}')
+
+    def parse(self, keys: Sequence[tuple]) -> list[str]:
+        '''Parse the precinct of each (itemname, manufacturer, model), or None if
+        no ward or no division is found'''
+        joined = pd.Series(['\0'.join(value if isinstance(value, str) else '' for value in key)
+                           for key in keys], dtype=object)
+        parts = joined.str.extract(f'^{PATTERN}$')
+        ward = parts['ward'].fillna(parts['manufacturer_ward'])
+        division = parts['division'].fillna(parts['model_division'])
+        precinct = ward.str.zfill(2) + '-' + division.str.zfill(2)
+        return precinct.astype(object).where(precinct.notna(), None).to_list()
+
+    def extract(self, df: pd.DataFrame) -> pd.Series:
+        '''Return the precinct of each row of a dataframe with KEY_FIELDS columns'''
+        values = df[KEY_FIELDS].astype(object)
+        values = values.where(values.notna(), None)
+        keys = list(values.itertuples(index=False, name=None))
+
+        unseen = [key for key in dict.fromkeys(keys) if key not in self._cache]
+        for key, precinct in zip(unseen, self.parse(unseen)):
+            self._cache[key] = precinct
+        if unseen:
+            self._changed = True
+
+        precincts = []
+        for key in keys:
+            self._cache.move_to_end(key)
+            precincts.append(self._cache[key])
+        self.stats['misses'] += len(unseen)
+        self.stats['hits'] += len(keys) - len(unseen)
+        self.stats['unparsed'] += sum(precinct == None for precinct in precincts)
+        self._evict()
+        return pd.Series(precincts, index=df.index, dtype=object)
+
+    def _evict(self):
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self._changed = True
+
+    def save(self):
+        '''Write the cache to its JSON file if any combination was added or evicted'''
+        if not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'pattern': PATTERN,
+                       'precincts': [[*key, precinct] for key, precinct in self._cache.items()]}, f)
+        os.replace(tmp_path, self.path)
+        self._changed = False
+
+    def summary(self) -> str:
+        '''Summarize the cache hit rate and unparsed assets of this run'''
+        lookups = self.stats['hits'] + self.stats['misses']
+        rate = self.stats['hits'] / lookups if lookups else 0
+        return (f'Precinct cache: {rate:.1%} of {lookups:,} assets hit, '
+                f'{self.stats["misses"]:,} new combinations parsed, '
+                f'{self.stats["unparsed"]:,} assets without a precinct, '
+                f'{len(self._cache):,} combinations cached')
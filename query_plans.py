@@ -0,0 +1,125 @@
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+import config as conf
+from config_db import asset_history, asset_router_locations, metadata, get_engine
+from run_asset_router_locations import join_select, array
+import click
+import json, logging, sys, urllib3
+import citygeo_secrets as cgs
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class Explain(sa.sql.expression.Executable, sa.sql.expression.ClauseElement):
+    '''EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) of a statement, which is executed'''
+    inherit_cache = False
+
+    def __init__(self, statement: sa.sql.expression.ClauseElement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element: Explain, compiler, **kwargs) -> str:
+    return f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {compiler.process(element.statement, **kwargs)}'
+
+
+def hot_statements(conn: sa.Connection, sample_size: int) -> dict[str, sa.Executable]:
+    '''Return the pipeline's statements whose time should scale with the rows they
+    touch rather than with the table, by name, for a sample of the most recently
+    updated asset ids and their precincts'''
+    assets = sa.Table("assets", metadata, schema=conf.SCHEMA, autoload_with=conn)
+    routers = sa.Table("routers", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=conn)
+    router_precincts = sa.Table("router_precincts", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=conn)
+    rows = conn.execute(sa
+                        .select(assets.c.id, assets.c.precinct)
+                        .order_by(assets.c.updated_on.desc())
+                        .limit(sample_size)).all()
+    ids = [row[0] for row in rows]
+    precincts = list({row[1] for row in rows if row[1] != None})
+    logger.info(f'Sample of {len(ids):,} asset ids in {len(precincts):,} precincts\n')
+    return {
+        'asset_history delete (history_writer.py)': sa
+            .delete(asset_history)
+            .where(asset_history.c.id.in_(ids)),
+        'asset_history watermarks (--incremental)': sa
+            .select(asset_history.c.id, sa.func.max(asset_history.c.lastseentime))
+            .where(asset_history.c.id.in_(ids))
+            .group_by(asset_history.c.id),
+        'asset_router_locations delete (incremental)': sa
+            .delete(asset_router_locations)
+            .where(sa.or_(
+                asset_router_locations.c.asset_id == sa.any_(array(ids)),
+                asset_router_locations.c.asset_precinct == sa.any_(array(precincts)))),
+        'asset_router_locations join (incremental)': join_select(
+            assets, routers, router_precincts, where=sa.or_(
+                assets.c.id == sa.any_(array(ids)),
+                assets.c.precinct == sa.any_(array(precincts)))),
+    }
+
+
+def seq_scans(plan: dict) -> list[tuple[str, int]]:
+    '''Return the relation and number of rows read of each sequential scan in a plan'''
+    scans = []
+    if plan['Node Type'] == 'Seq Scan':
+        rows = plan.get('Actual Rows', 0) + plan.get('Rows Removed by Filter', 0)
+        scans.append((plan.get('Relation Name'), rows * plan.get('Actual Loops', 1)))
+    for child in plan.get('Plans', []):
+        scans += seq_scans(child)
+    return scans
+
+
+def check_plans(engine: sa.Engine, min_rows: int, sample_size: int) -> list[str]:
+    '''Explain and analyze each of hot_statements(), logging its time and buffers,
+    and return the names of those with a sequential scan of at least `min_rows` rows.
+    Everything runs in one transaction that is rolled back, so the deletes are undone.'''
+    flagged = []
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            for name, statement in hot_statements(conn, sample_size).items():
+                result = conn.execute(Explain(statement)).scalar()
+                explained = (json.loads(result) if isinstance(result, str) else result)[0]
+                plan = explained['Plan']
+                logger.info(f'{name}: {explained["Execution Time"]:,.1f}ms, {plan["Actual Rows"]:,} rows, '
+                            f'{plan.get("Shared Hit Blocks", 0):,} buffers hit, '
+                            f'{plan.get("Shared Read Blocks", 0):,} read')
+                for relation, rows in seq_scans(plan):
+                    if rows >= min_rows:
+                        logger.warning(f'{name}: sequential scan of {rows:,} rows of {relation}')
+                        flagged.append(name)
+                logger.debug(json.dumps(plan, indent=2))
+        finally:
+            transaction.rollback()
+    return flagged
+
+
+@click.command
+@click.option('--test', is_flag=True, default=False, help='Use the test database')
+@click.option('--run_local', is_flag=True, default=False, help='Run this script on a local machine outside of AWS environment')
+@click.option('--log',
+              type=click.Choice(['error', 'warn', 'info', 'debug'], case_sensitive=False),
+              default='info', help='Log level to use; debug also logs each plan')
+@click.option('--min-rows', 'min_rows', type=int, default=conf.PLAN_SEQ_SCAN_ROWS, show_default=True,
+              help='Flag sequential scans of at least this many rows')
+@click.option('--sample', 'sample_size', type=int, default=conf.PLAN_SAMPLE_IDS, show_default=True,
+              help='Number of recently updated asset ids to run the statements for')
+def main(test: bool, run_local: bool, log: str, min_rows: int, sample_size: int):
+    '''Check the query plans of the pipeline's hot statements, exiting with an error
+    if any of them scans a whole table'''
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    cgs.set_config(keeper_dir='~')
+    cgs.set_config(log_level=log)
+    logger.setLevel(level=getattr(logging, log.upper()))
+    if run_local:
+        cgs.set_config(verify_ssl_certs=False)
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    flagged = check_plans(get_engine(test=test, run_local=run_local), min_rows, sample_size)
+    if flagged:
+        sys.exit(f'Statement(s) with sequential scans of at least {min_rows:,} rows: {", ".join(flagged)}')
+    logger.info('No large sequential scans found')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import config as conf
+from typing import NamedTuple
+import json, logging, os, sqlite3, threading, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class CacheEntry(NamedTuple):
+    data: dict
+    etag: str
+    last_modified: str
+    fresh: bool  # Stored within the TTL, so it can be used without a request
+
+    def conditional_headers(self) -> dict:
+        '''Headers that ask the API to reply 304 Not Modified if this entry is current'''
+        headers = {}
+        if self.etag != None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified != None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache():
+    '''On-disk cache of API responses, stored in a SQLite file
+    ```
+    cache = ResponseCache(conf.CACHE_PATH)
+    entry = cache.get(key)
+    if entry == None or not entry.fresh:
+        # request, with entry.conditional_headers() if entry != None
+        cache.put(key, response.text, response.headers)  # or cache.revalidated(key) on a 304
+    cache.close()
+    ```
+    Entries older than `ttl` seconds are returned as stale so that they can be
+    revalidated with a conditional request. Entries not used for `max_age` seconds,
+    such as the pages of an asset whose history has since grown (see
+    run_asset_history.get_cache_key()), are deleted when the cache is opened. Once
+    the file holds more than `max_bytes` of responses, the least recently used
+    entries are evicted.
+    Safe to use from multiple threads.
+    '''
+    def __init__(self, path: str, ttl: float = conf.CACHE_TTL_SECONDS,
+                 max_bytes: int = conf.CACHE_MAX_BYTES, max_age: float = conf.CACHE_MAX_AGE_SECONDS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'revalidated': 0,
+                      'stored': 0, 'evicted': 0, 'expired': 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, body TEXT NOT NULL, etag TEXT, last_modified TEXT,
+            stored_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.stats['expired'] = self._conn.execute(
+            'DELETE FROM responses WHERE accessed_at < ?', (time.time() - max_age,)).rowcount
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key: str) -> CacheEntry:
+        '''Return the cached entry for key, or None'''
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row == None:
+                self.stats['misses'] += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            fresh = now - row[3] <= self.ttl
+            self.stats['hits' if fresh else 'stale'] += 1
+        return CacheEntry(json.loads(row[0]), row[1], row[2], fresh)
+
+    def put(self, key: str, body: str, headers: dict):
+        '''Store a response body with its ETag/Last-Modified headers, evicting the
+        least recently used entries if the cache is over max_bytes'''
+        now = time.time()
+        size = len(body)
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, body, headers.get('ETag'), headers.get('Last-Modified'), now, now, size))
+            self._size += size - (old[0] if old != None else 0)
+            self.stats['stored'] += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def revalidated(self, key: str):
+        '''Record that the API confirmed (304) that a stale entry is current'''
+        with self._lock:
+            self._conn.execute('UPDATE responses SET stored_at = ? WHERE key = ?', (time.time(), key))
+            self.stats['revalidated'] += 1
+
+    def _evict(self):
+        '''Delete least recently used entries until under 90% of max_bytes'''
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+        keys = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            keys.append((key,))
+            self._size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self.stats['evicted'] += len(keys)
+
+    def summary(self) -> str:
+        '''Summarize the hit/miss statistics of this run'''
+        lookups = self.stats['hits'] + self.stats['stale'] + self.stats['misses']
+        served = self.stats['hits'] + self.stats['revalidated']
+        rate = served / lookups if lookups else 0
+        return (f'Response cache: {rate:.1%} of {lookups:,} lookups served from cache, '
+                f'{self.stats}, {self._size / 1e6:,.1f} MB on disk')
+
+    def close(self):
+        '''Close the SQLite file'''
+        self._conn.close()
@@ -1,23 +1,63 @@
-import sqlalchemy as sa, requests
-import config as conf, utils
-from config_db import asset_history, metadata, create_engine, setup_db_tables
-from assetdetails import request_new_access_token
-import citygeo_secrets as cgs
+import sqlalchemy as sa, pandas as pd, requests
+import config as conf
+from config_db import asset_history, metadata, get_engine as get_shared_engine, setup_db_tables
+from history_writer import HistoryWriter, page_columns
+from scheduler import DeadlineScheduler
+from response_cache import ResponseCache
+import history_queue, history_partitions
+from concurrency import ConcurrencyController, ThreadLimiter, OVERLOAD_STATUSES, parse_retry_after
+from assetdetails import refresh_api_token
+import secrets_cache
 from typing import Sequence
 from concurrent.futures import ThreadPoolExecutor
-import datetime as dt, zoneinfo, logging, time, threading, json
+import datetime as dt, zoneinfo, contextlib, logging, queue, time, threading, json, math, itertools
 from urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 
 
-def setup_global_vars(run_local: bool): 
-    '''Set up the global variables needed for multithreading'''
-    global base_url, base_headers, asset_histories, locally_run, thread_data
-    base_url = cgs.connect_with_secrets(get_base_url, conf.API_SECRET)
-    base_headers = cgs.connect_with_secrets(get_headers, conf.API_SECRET)
-    asset_histories = []
+global logger
+logger = logging.getLogger('main')
+
+
+def setup_global_vars(run_local: bool, writer: HistoryWriter, watermarks: dict = None, 
+                      adaptive: bool = False, use_cache: bool = True): 
+    '''Set up the global variables needed for multithreading
+    - `writer`: HistoryWriter that each thread pushes its pages of observations to
+    - `watermarks`: Dict of id -> newest stored lastseentime, used in incremental mode
+    - `adaptive`: Whether the number of concurrent calls adapts to the API's health
+    - `use_cache`: Whether to use the on-disk cache of older observation pages'''
+    global base_url, base_headers, history_writer, locally_run, id_watermarks
+    global controller, call_budget, page_executor, response_cache
+    base_url = secrets_cache.connect_with_secrets(get_base_url, conf.API_SECRET)
+    base_headers = secrets_cache.connect_with_secrets(get_headers, conf.API_SECRET)
+    history_writer = writer
     locally_run = run_local
-    thread_data = threading.local()
+    id_watermarks = watermarks if watermarks != None else {}
+    # Shared by the asset threads and the page threads so that no more than the 
+    # controller's limit of requests are ever in flight
+    controller = ConcurrencyController(conf.MAX_CONCURRENT_CALLS, adaptive=adaptive)
+    call_budget = ThreadLimiter(controller)
+    page_executor = ThreadPoolExecutor(
+        max_workers=controller.maximum, thread_name_prefix='page')
+    response_cache = ResponseCache(conf.CACHE_PATH) if use_cache else None
+
+
+# Idle sessions, kept across runs (e.g. of `run.py --daemon`) so that their connections stay open
+idle_sessions = queue.SimpleQueue()
+engines_set_up = set()  # Engines whose missing tables have been created, see get_engine()
+
+
+@contextlib.contextmanager
+def pooled_session(): 
+    '''Borrow an idle requests session for the asset history API, creating one if none is idle'''
+    try: 
+        session = idle_sessions.get_nowait()
+    except queue.Empty: 
+        session = create_session(retry_statuses=[])
+    try: 
+        yield session
+    finally: 
+        idle_sessions.put(session)
 
 
 def get_base_url(creds: dict) -> str: 
@@ -42,7 +82,6 @@ def validate_api_token(id: str):
     
     #### Parameters
     - `id`: The ID of an asset to get the history of. Becomes part of URL.'''    
-    global base_headers
     logger.info('Validating API Token')
     now = dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
 
@@ -54,146 +93,349 @@ def validate_api_token(id: str):
     # 14/15 is (mostly) arbitrary to represent that the token is close to expiring
     if previous_timestamp + (previous_expires_in_delta * 14/15) < now : 
         logger.info(f'Token is close to expiring. Attempting to refresh token\n')
-        response_json = cgs.connect_with_secrets(
-            request_new_access_token, conf.API_TOKEN_REFRESH_SECRET, full_response=True)
+        refresh_base_headers(bearer_key(base_headers), f'{base_url}{id}/observations')
+    else: 
+        logger.info(f'Current token valid until {str(previous_timestamp + previous_expires_in_delta)}')
+
+
+def bearer_key(headers: dict) -> str: 
+    '''Return the API token of the "Authorization" header from get_headers()'''
+    return headers['Authorization'].removeprefix('Bearer ')
+
+
+def refresh_base_headers(stale_key: str, url: str) -> dict | None: 
+    '''Replace the API token `stale_key`, expired or rejected with a 401, and the 
+    global base_headers that use it, returning the new headers or None if no new 
+    token was accepted. Safe to call from any number of fetch threads at once: 
+    only one new token is requested (see assetdetails.refresh_api_token()), and 
+    the thread that requested it records it in conf.API_UPDATE_FILE.
+    - `url`: Observations URL of an asset, requested to check that a new token works'''
+    global base_headers
+    def creds(api_key: str) -> dict: 
+        return {conf.API_SECRET: {'API_KEY': api_key}}
+
+    def is_ready(api_key: str) -> bool: 
+        with pooled_session() as session: 
+            response = session.get(url, headers=get_headers(creds(api_key)), params={'page': 1}, 
+                                   verify=not locally_run, timeout=conf.API_TIMEOUT_SECONDS)
+        return response.ok
+
+    response_json = refresh_api_token(stale_key, is_ready)
+    if response_json == None: 
+        return None
+    new_api_key = response_json['access_token']
+    base_headers = get_headers(creds(new_api_key))
+    if 'expires_in' in response_json: 
         api_update_dict = {}
-        new_api_key = response_json['access_token']
-        expires_in = response_json['expires_in']
-        creds = cgs.get_secrets(conf.API_SECRET)
-        old_api_key = creds[conf.API_SECRET]['API_KEY']
-        api_update_dict['timestamp'] = str(now)
-        api_update_dict['expires_in_seconds'] = expires_in
-        api_update_dict['old_key_ends_with'] = old_api_key[-5:]
+        api_update_dict['timestamp'] = str(dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern')))
+        api_update_dict['expires_in_seconds'] = response_json['expires_in']
+        api_update_dict['old_key_ends_with'] = stale_key[-5:]
         api_update_dict['new_key_ends_with'] = new_api_key[-5:]
-
-        # "Heisenbug" appears only in production but not in debugging. 
-        # Perhaps because this function runs in < 1 second in production, and their 
-        # API can't reset to a new token fast enough, causing it to reissue a 401 HTTP error...
         logger.info(f'API Update Information: {api_update_dict}')
-        creds[conf.API_SECRET]['API_KEY'] = new_api_key
-        logger.info('Sleeping for 5 seconds\n')
-        time.sleep(5) # Allow their API time to instate the new token
-        
-        base_headers = get_headers(creds) # global var; specified earlier in this func
-        s = create_session()        
-        page = 1
-        verify = not locally_run
-        url = f'{base_url}{id}/observations'
-        response = s.get(url, headers=base_headers, params={'page': page}, verify=verify)    
-
-        if response.ok: 
-            cgs.update_secret(conf.API_SECRET, {'API_KEY': new_api_key})
-            with open(conf.API_UPDATE_FILE, 'w') as f: 
-                json.dump(api_update_dict, f)
-                f.write('\n')
-    else: 
-        logger.info(f'Current token valid until {str(previous_timestamp + previous_expires_in_delta)}')
+        with open(conf.API_UPDATE_FILE, 'w') as f: 
+            json.dump(api_update_dict, f)
+            f.write('\n')
+    return base_headers
+
+
+def parse_lastseentime(value: str) -> dt.datetime: 
+    '''Parse the "lastSeenTime" of an observation, which may or may not have microseconds'''
+    try: 
+        return dt.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+    except ValueError: 
+        return dt.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+
+
+def get_watermarks(conn: sa.Connection, ids: Sequence[str]) -> dict: 
+    '''Return the newest lastseentime already stored in asset_history for each id'''
+    stmt = (sa
+            .select(asset_history.c.id, sa.func.max(asset_history.c.lastseentime))
+            .where(asset_history.c.id.in_(ids))
+            .group_by(asset_history.c.id))
+    watermarks = {row[0]: row[1] for row in conn.execute(stmt) if row[1] != None}
+    logger.info(f'Found stored history for {len(watermarks):,} of {len(ids):,} IDs\n')
+    return watermarks
 
     
+def consume_page(j: dict, watermark: dt.datetime, now: dt.datetime) -> tuple[list[dict], str]: 
+    '''Return the observations to keep from one page of the API response and, if 
+    paging should stop after this page, the reason why (otherwise None)
+
+    Observations are returned newest first, so once an observation at or before 
+    the watermark (incremental mode) or beyond HISTORY_RETENTION_DAYS is seen, stop paging. 
+    #### Parameters
+    - `j`: JSON of one page of the API response
+    - `watermark`: Newest lastseentime already stored for this id, or None
+    - `now`: Time the run began'''
+    data = j['data']
+    if data == []: 
+        return data, 'empty'
+
+    if watermark != None: # One vectorized parse of the page's timestamps
+        seen = pd.to_datetime([row['lastSeenTime'] for row in data], format='ISO8601', utc=True)
+        new_data = list(itertools.compress(data, seen > watermark))
+        if len(new_data) < len(data): 
+            return new_data, 'Reached stored observations'
+    else: 
+        new_data = data
+    if j['totalEntityCount'] < j['pageLength']: 
+        return new_data, 'last page'
+
+    latest = parse_lastseentime(data[-1]['lastSeenTime'])
+    if now - latest > dt.timedelta(days=conf.HISTORY_RETENTION_DAYS): 
+        return new_data, f'Beyond {conf.HISTORY_RETENTION_DAYS} days'
+    return new_data, None
+
+
+def get_page_count(j: dict) -> int: 
+    '''Return the number of pages of an id's history from the first page of the API response'''
+    if j['pageLength'] <= 0 or j['totalEntityCount'] < j['pageLength']: 
+        return 1
+    return math.ceil(j['totalEntityCount'] / j['pageLength'])
+
+
+def get_cache_key(id: str, total_count: int, page: int) -> str: 
+    '''Key of a page in the response cache
+
+    Observations are returned newest first, so a new observation shifts every 
+    older observation to a later position. Including the "totalEntityCount" of 
+    the (always requested) first page means a cached page is only used while the 
+    asset has had no new observations since it was stored.'''
+    return f'{id}/{total_count}/{page}'
+
+
+def get_page(url: str, page: int, cache_key: str = None) -> dict: 
+    '''Get one page of observations within the shared call budget
+
+    Each call's latency and any 429, 5xx, or timeout is reported to the 
+    concurrency controller; those calls are retried after the Retry-After 
+    header or an exponential backoff. If `cache_key` is given and the response 
+    cache is in use, a fresh cached page is returned without a request, and a 
+    stale one is revalidated with a conditional request. A 401 refreshes the 
+    API token (see refresh_base_headers()) and is retried once with the new token.'''
+    entry = None
+    conditional_headers = {}
+    if cache_key != None and response_cache != None: 
+        entry = response_cache.get(cache_key)
+        if entry != None and entry.fresh: 
+            return entry.data
+        if entry != None: 
+            conditional_headers = entry.conditional_headers()
+    headers = {**base_headers, **conditional_headers}
+    refreshed = False
+    verify = not locally_run
+    for attempt in range(conf.API_RETRIES + 1): 
+        with call_budget, pooled_session() as session: 
+            start = time.monotonic()
+            try: 
+                response = session.get(
+                    url, headers=headers, params={'page': page}, verify=verify, 
+                    timeout=conf.API_TIMEOUT_SECONDS)
+            except requests.Timeout: 
+                if attempt == conf.API_RETRIES: 
+                    raise
+                response = None
+            latency = time.monotonic() - start
+        if response != None and response.status_code not in OVERLOAD_STATUSES: 
+            controller.record_success(latency)
+            if response.status_code == 304 and entry != None: 
+                response_cache.revalidated(cache_key)
+                return entry.data
+            if response.status_code == 401 and not refreshed and attempt < conf.API_RETRIES: 
+                refreshed = True
+                new_headers = refresh_base_headers(bearer_key(headers), url)
+                if new_headers != None: 
+                    headers = {**new_headers, **conditional_headers}
+                    continue
+            response.raise_for_status()
+            if cache_key != None and response_cache != None: 
+                response_cache.put(cache_key, response.text, response.headers)
+            return response.json()
+        
+        if response == None: 
+            reason, retry_after = 'timeout', None
+        else: 
+            reason = f'HTTP {response.status_code}'
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        controller.record_overload(reason, retry_after)
+        if attempt == conf.API_RETRIES: 
+            response.raise_for_status()
+        time.sleep(retry_after if retry_after != None else 0.5 * (2 ** attempt))
+
+
+def log_asset_history(url: str, record_count: int, last_page: int, reason: str, consumer: str): 
+    '''Log the result of getting one id's history'''
+    print_string = f'Requesting {url = }\n'
+    if reason not in ('empty', 'last page'): 
+        print_string += f'\t{reason}, ceasing to extract records\n'
+    print_string += f'\t{record_count:,} records on {last_page} page(s) consumed by {consumer}'
+    logger.info(print_string)
+
+
 def get_asset_history(id: str):
-    '''Get the data from the API with multithreading, extending the global list 
-    asset_histories
+    '''Get the data from the API with multithreading, pushing each page of 
+    observations to the global history_writer
 
-    Each thread will have a separate instance of this function with one id at a time
+    Each thread will have a separate instance of this function with one id at a time. 
+    The first page gives the number of pages; the remaining pages are requested 
+    up to conf.PAGE_FANOUT at a time by the page threads and consumed in order. 
+    Only the remaining pages may come from the response cache. 
+    If the id has a watermark (incremental mode), stop paging once observations 
+    at or before the watermark are reached and keep only the newer observations. 
     #### Parameters
     - `id`: The ID of an asset to get the history of. Becomes part of URL.'''
-    if not hasattr(thread_data, "session"):
-        thread_data.session = create_session()
-    s = thread_data.session
     url = f'{base_url}{id}/observations'
     page = 1
-    id_history = []
-    print_string = f'Requesting {url = }\n'
+    record_count = 0
     now = dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
+    watermark = id_watermarks.get(id)
+    j = j_first = get_page(url, page)
+    page_count = get_page_count(j)
+    fetched = []
     while True: 
-        verify = not locally_run
-        response = s.get(url, headers=base_headers, params={'page': page}, verify=verify)    
-        response.raise_for_status()
-        j = response.json()
-        data = j['data']
-        if data == []: 
-            last_page = page - 1
-            break
-
-        id_history.extend(data)
-        if j['totalEntityCount'] < j['pageLength']: 
-            last_page = page
-            break
-
-        try: 
-            latest = dt.datetime.strptime(data[-1]['lastSeenTime'], "%Y-%m-%dT%H:%M:%S.%f%z")
-        except ValueError: 
-            latest = dt.datetime.strptime(data[-1]['lastSeenTime'], "%Y-%m-%dT%H:%M:%S%z")
-        if now - latest > dt.timedelta(days=365): 
-            print_string += f'\tBeyond 365 days, ceasing to extract records\n'
-            last_page = page
+        data, reason = consume_page(j, watermark, now)
+        if reason == None and page >= page_count: 
+            reason = 'last page'
+        record_count += len(data)
+        history_writer.put(id, page_columns(id, data, now), final=reason != None)
+        if reason != None: 
+            last_page = page - 1 if reason == 'empty' else page
             break
+        if fetched == []: # Request the next window of pages concurrently
+            window = range(page + 1, min(page + conf.PAGE_FANOUT, page_count) + 1)
+            fetched = [page_executor.submit(
+                get_page, url, p, get_cache_key(id, j_first['totalEntityCount'], p)) 
+                for p in window]
+        j = fetched.pop(0).result()
         page += 1
+    for future in fetched: # Pages beyond the cutoff are no longer needed
+        future.cancel()
     
-    print_string += f'\t{len(id_history):,} records on {last_page} page(s) consumed by thread {threading.current_thread().name}'
-    for row in id_history: 
-        row['id'] = id
-    
-    logger.info(print_string)
-    asset_histories.extend(id_history)
+    log_asset_history(url, record_count, last_page, reason, 
+                      consumer=f'thread {threading.current_thread().name}')
+
+
+def try_asset_history(id: str): 
+    '''Get the history of one id, recording a failure in the work queue rather 
+    than raising so that the other ids still complete'''
+    try: 
+        get_asset_history(id)
+    except Exception as e: 
+        logger.error(f'Failed to get history of {id}: {e!r}')
+        history_writer.fail(id, e)
     
 
-def create_session() -> requests.Session: 
-    '''Ceate the requests session for automatic retries on a 500 error'''
+def create_session(retry_statuses: list[int] = [500]) -> requests.Session: 
+    '''Ceate the requests session for automatic retries on a 500 error
+    - `retry_statuses`: HTTP status codes to automatically retry. Connection 
+    errors are always retried.'''
     # https://requests.readthedocs.io/en/latest/user/advanced/#example-automatic-retries
     s = requests.Session()
     retries = Retry(
         total=5,
         backoff_factor=0.5,
-        status_forcelist=[500],
+        status_forcelist=retry_statuses,
         allowed_methods={'GET', 'POST'}
     )
     s.mount('https://', HTTPAdapter(max_retries=retries))
     return s
 
 
-def update(ids: Sequence[str], run_local:bool, test: bool = True):
-    '''Update asset_history table'''
+def get_engine(test: bool, run_local: bool) -> sa.Engine: 
+    '''Return the shared engine, creating any missing tables the first time'''
+    engine = get_shared_engine(test=test, run_local=run_local)
+    if engine not in engines_set_up: 
+        setup_db_tables(engine, metadata, drop=False)
+        engines_set_up.add(engine)
+    return engine
+
+
+def enqueue_ids(database, ids: Sequence[str]): 
+    '''Add the ids upserted into Assets to the asset history work queue, in the 
+    current transaction of the peewee `database` (see run_assets.run_pipeline()), so 
+    that the ids are queued if and only if their upsert commits. The work queue table 
+    must already exist - see get_engine().'''
+    stmt = history_queue.enqueue_statement(ids)
+    if stmt is None: 
+        return
+    compiled = stmt.compile(dialect=database.engine.dialect)
+    database.execute_sql(str(compiled), compiled.params)
+    logger.info(f'Enqueued {len(ids):,} IDs for asset history\n')
+
+
+def count_pending(run_local: bool, test: bool = True) -> int: 
+    '''Return the number of ids in the asset history work queue that the next run would claim'''
+    engine = get_engine(test=test, run_local=run_local)
+    with engine.connect() as conn: 
+        return history_queue.count_claimable(conn)
+
+
+def update(run_local:bool, test: bool = True, incremental: bool = False, 
+           engine_type: str = 'threads', adaptive: bool = False, deadline: float = None, 
+           use_cache: bool = True) -> int:
+    '''Update asset_history table for the ids in the work queue - those enqueued 
+    with their upsert (see enqueue_ids()) plus any left by previous runs - returning 
+    the number of ids processed
+    - `incremental`: If True, only append observations newer than those already 
+    stored for each id rather than deleting and re-fetching each id's history
+    - `engine_type`: Fetch engine to use, either "threads" (ThreadPoolExecutor) or 
+    "asyncio" (see async_history.py)
+    - `adaptive`: If True, adapt the number of concurrent calls to the API's 
+    latency and errors (see concurrency.py) rather than fixing it at MAX_CONCURRENT_CALLS
+    - `deadline`: time.monotonic() value after which no new id is started; the rest 
+    are deferred to the next run. Defaults to HISTORY_DEADLINE_SECONDS from now.
+    - `use_cache`: If False, do not use the on-disk cache of older observation pages 
+    (see response_cache.py)'''
     global logger
     logger = logging.getLogger('main')
     
     logger.info(f'{"*" * 80}')
     logger.info('Beginning Run Asset History script\n')
+    if deadline == None: 
+        deadline = time.monotonic() + conf.HISTORY_DEADLINE_SECONDS
     
-    engine = cgs.connect_with_secrets(create_engine, 
-        conf.DB_SECRET_HOST, conf.DB_SECRET_HOST_TEST, 
-        conf.DB_SECRET_LOCAL, conf.DB_SECRET_LOCAL_TEST, 
-        conf.DB_SECRET_LOGIN, 
-        test=test, run_local=run_local)
-    
-    setup_db_tables(engine, metadata, drop=False)
-    setup_global_vars(run_local=run_local)
-    validate_api_token(id=ids[0])
+    engine = get_engine(test=test, run_local=run_local)
+    history_partitions.maintain(engine) # Before any history is written into the partitions
+    with engine.begin() as conn: 
+        ids = history_queue.claim(conn)
+    if ids == []: 
+        logger.info('No IDs in the asset history work queue\n')
+        return 0
 
-    with ThreadPoolExecutor(max_workers=min(len(ids), conf.MAX_CONCURRENT_CALLS)) as executor: # Automatically waits for all futures to finish executing
-        iterator = executor.map(get_asset_history, ids, timeout=300)
-        print(f'Active thread count: {threading.active_count()}\n')
-    for _ in iterator: # Go through each thread afterwards and detect if any error occured
-        pass
-    
-    # Unfortunately iterating twice through the data now in order to match lower_case and add updated_on
-    now = dt.datetime.now(
-        tz=zoneinfo.ZoneInfo('US/Eastern'))
-    data = []
-    for row in asset_histories: 
-        new_row = {k.lower(): v for k, v in row.items()}
-        new_row['updated_on'] = now
-        data.append(new_row)
+    watermarks = None
+    if incremental: 
+        logger.info('Incremental mode - appending only new observations\n')
+        with engine.connect() as conn: 
+            watermarks = get_watermarks(conn, ids)
+    writer = HistoryWriter(engine, incremental=incremental)
+    setup_global_vars(run_local=run_local, writer=writer, watermarks=watermarks, adaptive=adaptive, 
+                      use_cache=use_cache)
+    validate_api_token(id=ids[0])
+    scheduler = DeadlineScheduler(ids, deadline)
+    logger.info(f'{scheduler.remaining_seconds():,.0f} seconds until the asset history deadline\n')
 
+    # Fetch workers push pages to the writer, which loads them while fetching continues
+    writer.start()
+    try: 
+        if engine_type == 'asyncio': 
+            import async_history
+            async_history.fetch_histories(
+                scheduler, base_url, base_headers, verify=not locally_run, 
+                writer=history_writer, controller=controller, cache=response_cache, 
+                watermarks=id_watermarks)
+        else: 
+            max_workers = min(len(ids), controller.maximum)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor: 
+                scheduler.run_threads(executor, try_asset_history, max_workers)
+                print(f'Active thread count: {threading.active_count()}\n')
+    finally: 
+        page_executor.shutdown(cancel_futures=True)
+        logger.info(controller.summary())
+        if response_cache != None: 
+            logger.info(response_cache.summary())
+            response_cache.close()
+        writer.close()
     with engine.begin() as conn: 
-        # Delete all IDs updated in Assets
-        stmt_delete = (sa
-                        .delete(asset_history)
-                        .where(asset_history.c.id.in_(ids)))
-        result = conn.execute(stmt_delete)
-        utils.print_sa_stmt(stmt_delete, result.rowcount)
-        
-        # Append the history of those IDs updated in or newly appended to Assets
-        stmt = sa.insert(asset_history)
-        result = conn.execute(stmt, data)
-        utils.print_sa_stmt(stmt, len(asset_histories))
+        history_queue.defer(conn, scheduler.deferred)
+        logger.info(f'Asset history work queue: {history_queue.count_by_status(conn)}\n')
+    return scheduler.started
@@ -1,7 +1,10 @@
 import sqlalchemy as sa, logging
-import config as conf, utils
-from config_db import asset_router_locations, metadata, create_engine, setup_db_tables
-import citygeo_secrets as cgs
+from sqlalchemy.dialects import postgresql
+import config as conf, utils, db_indexes
+from config_db import asset_router_locations, asset_router_locations_state, metadata, get_engine, setup_db_tables
+from config_db import copy_grants, dependent_views
+from typing import Sequence
+import datetime as dt, zoneinfo, time
 
 
 def get_rowcount(db_conn: sa.Connection, table: sa.Table) -> int: 
@@ -12,11 +15,41 @@ def get_rowcount(db_conn: sa.Connection, table: sa.Table) -> int:
     return rowcount
 
 
-def join_assets_routers(assets: sa.Table, routers: sa.Table, 
-        router_precincts: sa.Table, asset_router_locations: sa.Table, conn: sa.Connection): 
-    '''Join Assets and Routers table together by precinct via router_precincts'''
-    pass
-    stmt_select = (
+def array(values: Sequence[str]) -> sa.BindParameter: 
+    '''Bind values as one Postgres array, for `column == sa.any_(array(values))`'''
+    return sa.literal(sorted(values), postgresql.ARRAY(sa.String))
+
+
+def precinct_fingerprints(routers: sa.Table, router_precincts: sa.Table, conn: sa.Connection) -> dict[str, str]: 
+    '''Return each precinct of router_precincts -> an md5 of its router_precincts and 
+    routers rows, which changes whenever any router joined to the precinct changes'''
+    row = sa.cast(sa.tuple_(*router_precincts.c, *routers.c), sa.Text)
+    stmt = (sa
+        .select(
+            router_precincts.c.precinct, 
+            sa.func.md5(sa.func.string_agg(row, postgresql.aggregate_order_by(sa.literal('\n'), row))))
+        .select_from(router_precincts.outerjoin(routers, router_precincts.c.id == routers.c.id))
+        .where(router_precincts.c.precinct != None)
+        .group_by(router_precincts.c.precinct)
+    )
+    return {str(precinct): fingerprint for precinct, fingerprint in conn.execute(stmt)}
+
+
+def save_fingerprints(conn: sa.Connection, fingerprints: dict[str, str]): 
+    '''Replace the stored fingerprint of every precinct'''
+    timestamp = dt.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
+    conn.execute(sa.delete(asset_router_locations_state))
+    if fingerprints: 
+        conn.execute(sa.insert(asset_router_locations_state), [
+            {'precinct': precinct, 'fingerprint': fingerprint, 'updated_on': timestamp} 
+            for precinct, fingerprint in fingerprints.items()])
+
+
+def join_select(assets: sa.Table, routers: sa.Table, router_precincts: sa.Table, 
+                where: sa.ColumnElement = None) -> sa.Select: 
+    '''Return the SELECT joining Assets and Routers together by precinct via router_precincts
+    - `where`: Condition on assets for the rows to select; by default all assets'''
+    return (
         sa.Select(
             assets.c.precinct.label("asset_precinct") , 
             assets.c.id.label("asset_id") , 
@@ -66,42 +99,174 @@ def join_assets_routers(assets: sa.Table, routers: sa.Table,
         .select_from(assets)
         .join(router_precincts, assets.c.precinct == router_precincts.c.precinct, isouter=True)
         .join(routers, router_precincts.c.id == routers.c.id, isouter=True)
+        .where(where if where is not None else sa.true())
         .order_by(assets.c.precinct, routers.c.name, assets.c.itemname)
-        .subquery()
     )
+
+
+def join_assets_routers(assets: sa.Table, routers: sa.Table, 
+        router_precincts: sa.Table, asset_router_locations: sa.Table, conn: sa.Connection, 
+        where: sa.ColumnElement = None) -> int: 
+    '''Join Assets and Routers table together by precinct via router_precincts, 
+    returning the number of rows inserted
+    - `where`: Condition on assets for the rows to insert; by default all assets'''
+    stmt_select = join_select(assets, routers, router_precincts, where).subquery()
     stmt = asset_router_locations.insert().from_select(stmt_select.c, stmt_select)
     result = conn.execute(stmt)
     updated_rowcount = get_rowcount(conn, asset_router_locations)
     utils.print_sa_stmt(stmt, updated_rowcount)    
+    return result.rowcount
+
+
+def rebuild_in_place(assets: sa.Table, routers: sa.Table, router_precincts: sa.Table, 
+                     engine: sa.Engine) -> tuple[int, int]: 
+    '''Rebuild the whole table with DELETE and INSERT in one transaction, returning 
+    the number of rows deleted and inserted'''
+    with engine.begin() as conn: 
+        fingerprints = precinct_fingerprints(routers, router_precincts, conn)
+        stmt = sa.delete(asset_router_locations)  
+        result = conn.execute(stmt)
+        utils.print_sa_stmt(stmt, result.rowcount)
+        count_inserted = join_assets_routers(
+            assets, routers, router_precincts, asset_router_locations, conn)
+        save_fingerprints(conn, fingerprints)
+    return result.rowcount, count_inserted
+
+
+def rebuild_by_swap(assets: sa.Table, routers: sa.Table, router_precincts: sa.Table, 
+                    engine: sa.Engine) -> tuple[int, int]: 
+    '''Rebuild the whole table in a shadow table and rename it in place of the 
+    table, returning the number of rows replaced and inserted
+
+    The shadow table is filled and then indexed and analyzed without locking the 
+    table, so readers (e.g. the Oracle/AGO sync DAG) keep reading the old rows 
+    meanwhile. The swap itself is two renames in a short transaction that waits 
+    at most ROUTER_SWAP_LOCK_TIMEOUT_MS for readers, and is retried up to 
+    ROUTER_SWAP_ATTEMPTS times. No dead tuples are left behind: the old table is 
+    dropped, or kept as "<table>_old" for rollback if ROUTER_SWAP_KEEP_OLD.'''
+    table = asset_router_locations
+    shadow = table.to_metadata(sa.MetaData(), name=f'{table.name}_shadow')
+    old_name = f'{table.name}_old'
+    with engine.begin() as conn: 
+        fingerprints = precinct_fingerprints(routers, router_precincts, conn)
+        count_old = get_rowcount(conn, table)
+        shadow.drop(conn, checkfirst=True) # Left by a failed rebuild
+        conn.execute(sa.schema.CreateTable(shadow)) # Without indexes, built once the rows are in
+        count_inserted = join_assets_routers(assets, routers, router_precincts, shadow, conn)
+        for index in table.indexes: # Named for the table once swapped in
+            sa.Index(f'{index.name}_shadow', *[shadow.c[column.name] for column in index.columns], 
+                     unique=index.unique).create(conn)
+        conn.execute(sa.text(f'ANALYZE {shadow.schema}.{shadow.name}'))
+        copy_grants(conn, table, shadow)
+    logger.info(f'Built {shadow.schema}.{shadow.name} with {count_inserted:,} rows - swapping it in\n')
+
+    for attempt in range(1, conf.ROUTER_SWAP_ATTEMPTS + 1): 
+        try: 
+            with engine.begin() as conn: 
+                conn.execute(sa.text(f"SET LOCAL lock_timeout = '{conf.ROUTER_SWAP_LOCK_TIMEOUT_MS}ms'"))
+                conn.execute(sa.text(f'DROP TABLE IF EXISTS {table.schema}.{old_name}'))
+                conn.execute(sa.text(f'ALTER TABLE {table.schema}.{table.name} RENAME TO {old_name}'))
+                for index in table.indexes: 
+                    conn.execute(sa.text(f'ALTER INDEX IF EXISTS {table.schema}.{index.name} RENAME TO {index.name}_old'))
+                conn.execute(sa.text(f'ALTER TABLE {shadow.schema}.{shadow.name} RENAME TO {table.name}'))
+                for index in table.indexes: 
+                    conn.execute(sa.text(f'ALTER INDEX {table.schema}.{index.name}_shadow RENAME TO {index.name}'))
+                save_fingerprints(conn, fingerprints)
+            break
+        except sa.exc.OperationalError as e: # lock_timeout while readers hold the table
+            if attempt == conf.ROUTER_SWAP_ATTEMPTS: 
+                raise
+            logger.warning(f'Swap attempt {attempt} of {conf.ROUTER_SWAP_ATTEMPTS} failed - retrying: {e.orig!r}')
+            time.sleep(attempt)
+    logger.info(f'Swapped {table.schema}.{shadow.name} in as {table.schema}.{table.name}\n')
 
+    if not conf.ROUTER_SWAP_KEEP_OLD: 
+        with engine.begin() as conn: 
+            conn.execute(sa.text(f'DROP TABLE {table.schema}.{old_name}'))
+    return count_old, count_inserted
 
-def main(test: bool = False, run_local:bool=False, drop: bool = False): 
+
+tables_set_up = {}  # Engine -> (assets, routers, router_precincts), see setup_tables()
+
+
+def setup_tables(engine: sa.Engine, drop: bool = False) -> tuple[sa.Table, sa.Table, sa.Table]: 
+    '''Reflect the assets, routers, and router_precincts tables and create any missing 
+    tables and indexes, returning the reflected tables. Done once per engine (unless 
+    `drop`), before any stage that shares the metadata starts - see run_assets.run_pipeline().
+    - `drop`: Whether to drop tables. DESTRUCTIVE.'''
+    if engine in tables_set_up and not drop: 
+        return tables_set_up[engine]
+    # assets, routers, and router_precincts tables must already exist for this script to run
+    assets = sa.Table("assets", metadata, schema=conf.SCHEMA, autoload_with=engine) 
+    routers = sa.Table("routers", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=engine)
+    router_precincts = sa.Table("router_precincts", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=engine)
+
+    setup_db_tables(engine, metadata, drop)
+    db_indexes.ensure_indexes(engine, db_indexes.EXTERNAL_INDEXES)
+    tables_set_up[engine] = (assets, routers, router_precincts)
+    return tables_set_up[engine]
+
+
+def main(test: bool = False, run_local:bool=False, drop: bool = False, ids: Sequence[str] = None, 
+         tables: tuple[sa.Table, sa.Table, sa.Table] = None): 
     '''Update asset_router_locations table
+    
+    Only the rows of the given asset ids, and of the assets in precincts whose 
+    router_precincts or routers rows changed since the last update (see 
+    precinct_fingerprints()), are deleted and joined again. The whole table is 
+    rebuilt if `ids` is None or there is no stored fingerprint to compare with - 
+    see rebuild_by_swap().
     - `test`: Whether to use test credentials
     - `run_local`: If True, do not validate SSL certificates
-    - `drop`: Whether to drop tables. DESTRUCTIVE. '''
+    - `drop`: Whether to drop tables. DESTRUCTIVE. 
+    - `ids`: Asset ids upserted or deleted since the last update
+    - `tables`: (assets, routers, router_precincts) from setup_tables(); by default 
+    they are set up here'''
     global logger
     logger = logging.getLogger('main')
 
     logger.info(f'{"*" * 80}')
     logger.info('Beginning Run Asset Router Locations script\n')
     logger.info(f'Test mode: {test}')
-    engine = cgs.connect_with_secrets(create_engine, 
-        conf.DB_SECRET_HOST, conf.DB_SECRET_HOST_TEST, 
-        conf.DB_SECRET_LOCAL, conf.DB_SECRET_LOCAL_TEST, 
-        conf.DB_SECRET_LOGIN,  
-        test=test, run_local=run_local)
-    
-    # assets, routers, and router_precincts tables must already exist for this script to run
-    assets = sa.Table("assets", metadata, schema=conf.SCHEMA, autoload_with=engine) 
-    routers = sa.Table("routers", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=engine)
-    router_precincts = sa.Table("router_precincts", metadata, schema=conf.VIEWER_SCHEMA, autoload_with=engine)
-
-    setup_db_tables(engine, metadata, drop)
+    engine = get_engine(test=test, run_local=run_local)
+    if tables == None or drop: 
+        tables = setup_tables(engine, drop)
+    assets, routers, router_precincts = tables
     
+    # Forget the fingerprints until this update commits, so that if it fails the 
+    # next one rebuilds the whole table rather than missing this run's ids
     with engine.begin() as conn: 
-        stmt = sa.delete(asset_router_locations)  
-        result = conn.execute(stmt)
-        utils.print_sa_stmt(stmt, result.rowcount)
+        stored = dict(conn.execute(sa.select(
+            asset_router_locations_state.c.precinct, asset_router_locations_state.c.fingerprint)).all())
+        conn.execute(sa.delete(asset_router_locations_state))
 
-        join_assets_routers(assets, routers, router_precincts, asset_router_locations, conn)
+    if ids == None or stored == {}: 
+        logger.info('Rebuilding the whole asset_router_locations table\n')
+        with engine.connect() as conn: 
+            views = dependent_views(conn, asset_router_locations)
+        if views: # A view would follow the renamed table, so would keep reading the old one
+            logger.warning(f'Views {views} select from asset_router_locations - rebuilding it in place')
+            count_deleted, count_inserted = rebuild_in_place(assets, routers, router_precincts, engine)
+        else: 
+            count_deleted, count_inserted = rebuild_by_swap(assets, routers, router_precincts, engine)
+    else: 
+        with engine.begin() as conn: 
+            fingerprints = precinct_fingerprints(routers, router_precincts, conn)
+            precincts = [precinct for precinct in fingerprints.keys() | stored.keys() 
+                         if fingerprints.get(precinct) != stored.get(precinct)]
+            logger.info(f'{len(ids):,} assets changed and {len(precincts):,} precincts have changed routers\n')
+            logger.debug(f'Precincts with changed routers: {sorted(precincts)}')
+            count_deleted, count_inserted = 0, 0
+            if ids or precincts: 
+                stmt = sa.delete(asset_router_locations).where(sa.or_(
+                    asset_router_locations.c.asset_id == sa.any_(array(ids)), 
+                    asset_router_locations.c.asset_precinct == sa.any_(array(precincts))))
+                count_deleted = conn.execute(stmt).rowcount
+                count_inserted = join_assets_routers(
+                    assets, routers, router_precincts, asset_router_locations, conn, 
+                    where=sa.or_(
+                        assets.c.id == sa.any_(array(ids)), 
+                        assets.c.precinct == sa.any_(array(precincts))))
+            save_fingerprints(conn, fingerprints)
+    logger.info(f'{count_deleted + count_inserted:,} asset_router_locations rows touched '
+                f'({count_deleted:,} deleted, {count_inserted:,} inserted)\n')
@@ -0,0 +1,358 @@
+from assetdetails import iter_asset_records
+from sftp_publisher import SftpPublisher
+from stages import Stage, run_stages, SUCCEEDED
+import config, config_db, db_indexes, utils, run_asset_router_locations, run_asset_history, dag_trigger, bulk_load, export
+from models import init_db, migrate_db, blank_db, Asset, Asset_Temp
+import playhouse.postgres_ext as pwp
+from precinct import PrecinctExtractor
+from peewee import Expression
+import pandas as pd
+import os, sys, datetime, zoneinfo, itertools, hashlib, logging, time
+from typing import Iterator, Sequence
+
+
+global logger
+logger = logging.getLogger('main')
+
+precincts = None  # PrecinctExtractor kept between runs, see run_pipeline()
+
+
+API_FIELDS = [field.name for field in Asset._meta.sorted_fields 
+              if field.name not in ('updated_on', 'precinct', 'content_hash')]  # Fields kept from the API
+
+
+def prepare_df(asset_list: list) -> pd.DataFrame: 
+    '''Prepare dataframe from data, with the columns of API_FIELDS in order whichever 
+    of them the records have, and None for every missing value'''
+    logger.info(f"{len(asset_list):,} assets found.")
+    logger.info(f'Preparing records...\n')
+    df = pd.DataFrame(asset_list)
+    df.columns = [x.lower() for x in df.columns]
+    # Drop any fields that come from the API but aren't defined in our table schema, 
+    # so that every chunk of a stream (and a whole payload) has the same columns
+    df = df.reindex(columns=API_FIELDS)
+    df = df.astype(object).where(df.notna(), None)
+    df['updated_on'] = datetime.datetime.now(tz=zoneinfo.ZoneInfo('US/Eastern'))
+    df = extract_precinct(df)
+    df = add_content_hash(df)
+    return df
+
+
+HASH_FIELDS = [field.name for field in Asset._meta.sorted_fields 
+               if field.name not in ('updated_on', 'content_hash')]  # Fixed order of hashed fields
+
+
+def canonical_value(value) -> str: 
+    '''String form of a value for content_hash, the same whatever its dtype: None and 
+    NaN are "\\N", and a whole-number float (e.g. from a column with NaN) is written as an int'''
+    if pd.isna(value): 
+        return '\\N'
+    if isinstance(value, float) and value.is_integer(): 
+        value = int(value)
+    return str(value)
+
+
+def add_content_hash(df: pd.DataFrame) -> pd.DataFrame: 
+    '''Add a content_hash column - a 64-bit BLAKE2 hash (as 16 hex characters) of the 
+    canonical values of HASH_FIELDS of each row, used by upsert() to find changed records. 
+    It depends only on the values, not on the pandas version or the columns' dtypes.'''
+    df['content_hash'] = [
+        hashlib.blake2b('\x1f'.join(map(canonical_value, row)).encode(), digest_size=8).hexdigest() 
+        for row in df[HASH_FIELDS].itertuples(index=False, name=None)]
+    return df
+    
+
+def stream_to_temp(records: Iterator[dict]) -> pd.DataFrame: 
+    '''Load records streamed from the API (see iter_asset_records()) into the temp 
+    table in chunks of config.ASSET_CHUNK_SIZE, so that only one chunk is held in 
+    memory at a time. Returns an empty dataframe with the columns loaded.'''
+    df = None
+    count = 0
+    while chunk := list(itertools.islice(records, config.ASSET_CHUNK_SIZE)): 
+        df = prepare_df(chunk)
+        count += load_temp(df)
+    if df is None: 
+        sys.exit('Assets API returned no assets - not updating any tables')
+    logger.info(f'{count:,} assets streamed into temp table\n')
+    return df.iloc[0:0]
+
+
+def delete_removed_ids() -> list[str]: 
+    '''Remove records that no longer appear in the API, i.e. are not in the temp table 
+    (see load_temp()), returning the ids deleted. Refuses to run against an empty 
+    temp table, which would delete every record.'''
+    if not Asset_Temp.select().exists(): 
+        sys.exit('Temp table is empty - not removing every record from Assets')
+    # NOT EXISTS is planned as an anti-join against the temp table's primary key, 
+    # rather than sending every current id as a bind parameter of NOT IN
+    database = Asset._meta.database
+    cursor = database.execute_sql(
+        f'DELETE FROM {Asset._meta.schema}.{Asset._meta.table_name} AS a '
+        f'WHERE NOT EXISTS (SELECT 1 FROM {Asset_Temp._meta.table_name} AS t WHERE t.id = a.id) '
+        f'RETURNING a.id')
+    ids_deleted = [row[0] for row in cursor.fetchall()]
+    logger.info(f'Removed {len(ids_deleted):,} IDs no longer in API\n')
+    logger.debug(f'IDs removed: {ids_deleted}')
+    return ids_deleted
+
+
+def load_temp(df: pd.DataFrame) -> int: 
+    '''Bulk load the dataframe into the temp table with COPY, returning row count'''
+    logger.info(f'Inserting into temp table...\n')
+    database = Asset_Temp._meta.database
+    with database.atomic(): 
+        count = bulk_load.copy_rows(
+            database.connection(), Asset_Temp._meta.table_name, list(df.columns), 
+            df.itertuples(index=False, name=None))
+        database.execute_sql(f'ANALYZE {Asset_Temp._meta.table_name}') # Temp tables are not autovacuumed
+    logger.info(f'{count:,} records copied into temp table\n')
+    return count
+
+
+def upsert(df: pd.DataFrame) -> Sequence[tuple[str]]: 
+    '''Upsert API records already in the temp table (see load_temp()) into database, 
+    return ids updated/inserted'''
+    backfill_content_hash(df)
+
+    logger.info(f'Determining new or updated records...\n')
+    id_subquery = (Asset_Temp
+                   .select(Asset_Temp.id)
+                   .join(Asset, on=(
+                       (Asset.id == Asset_Temp.id) & 
+                       (Asset.content_hash == Asset_Temp.content_hash))))
+    delete_query = Asset_Temp.delete().where(Asset_Temp.id.in_(id_subquery))
+    delete_query.execute() # Delete unchanged records from temp table
+    get_changed_fields(df)
+
+    logger.info('Upserting records...\n')
+    fields = list(Asset_Temp._meta.fields.values())
+    upsert_query = (Asset.insert_from(Asset_Temp.select(), fields=fields)
+        .on_conflict(
+            conflict_target=[Asset.id], 
+            preserve=fields)
+        .returning(Asset.id))
+    rv = upsert_query.execute() # Upsert only the changed records to maintain the "updated_on" field
+    
+    row_count = Asset.select().count()
+    ids = rv.cursor.fetchall()
+    count_upserted = len(ids)
+    logger.info(f'{count_upserted:,} records inserted or updated since last API request')
+    logger.info(f'{row_count:,} records now exist\n')
+    return ids
+
+
+def backfill_content_hash(df: pd.DataFrame): 
+    '''Set the content_hash of Assets records stored before that column existed, 
+    where the record is identical to the temp table, so they are not all seen as changed'''
+    if not Asset.select().where(Asset.content_hash.is_null()).exists(): 
+        return
+    asset_intersect_fields = get_intersect_fields(
+        df, Asset._meta.fields, ['updated_on', 'content_hash'])
+    asset_temp_intersect_fields = get_intersect_fields(
+        df, Asset_Temp._meta.fields, ['updated_on', 'content_hash'])
+    intersect_subquery = (
+        Asset_Temp
+        .select(*asset_temp_intersect_fields)
+        .intersect(    
+            Asset    
+            .select(*asset_intersect_fields)
+            .where(Asset.content_hash.is_null())))
+    id_subquery = intersect_subquery.select_from(intersect_subquery.c.id)
+    count = (Asset
+             .update(content_hash=Asset_Temp.content_hash)
+             .from_(Asset_Temp)
+             .where((Asset.id == Asset_Temp.id) & Asset.id.in_(id_subquery))
+             .execute())
+    logger.info(f'Backfilled content_hash for {count:,} unchanged records\n')
+
+
+def get_changed_fields(df: pd.DataFrame) -> dict[str, list[str]]: 
+    '''Return the fields that changed for each existing id left in the temp table, 
+    as id -> list of field names, logging the number of ids changed per field'''
+    asset_fields = get_intersect_fields(
+        df, Asset._meta.fields, ['id', 'updated_on', 'content_hash'])
+    asset_temp_fields = get_intersect_fields(
+        df, Asset_Temp._meta.fields, ['id', 'updated_on', 'content_hash'])
+    query = (Asset_Temp
+             .select(Asset_Temp.id, *[
+                 Expression(temp_field, 'IS DISTINCT FROM', field) 
+                 for temp_field, field in zip(asset_temp_fields, asset_fields)])
+             .join(Asset, on=(Asset.id == Asset_Temp.id))
+             .tuples())
+    changed_fields = {}
+    for id, *distinct in query: 
+        changed_fields[id] = [field.name for field, changed in zip(asset_fields, distinct) if changed]
+        logger.debug(f'{id} changed: {", ".join(changed_fields[id])}')
+    field_counts = {field.name: 0 for field in asset_fields}
+    for fields in changed_fields.values(): 
+        for name in fields: 
+            field_counts[name] += 1
+    field_counts = {name: count for name, count in field_counts.items() if count > 0}
+    logger.info(f'{len(changed_fields):,} existing records changed, by field: {field_counts}\n')
+    return changed_fields
+
+
+def get_intersect_fields(df: pd.DataFrame, meta_fields: dict, ignore_fields: list[str]) -> list: 
+    '''Return the peewee field types present in a dataframe
+    - ignore_fields (list[str]): List of fields in dataframe to ignore
+    '''
+    intersect_fields = []
+    for field in df.drop(columns=ignore_fields).columns: 
+        peewee_field = meta_fields[field]
+        intersect_fields.append(peewee_field)
+    return intersect_fields
+
+
+def extract_precinct(df: pd.DataFrame) -> pd.DataFrame: 
+    '''Extract precinct from data in the following priority, using the global 
+    PrecinctExtractor so that only unseen combinations of these fields are parsed: 
+    1. itemname
+    2. manufacturer & model
+    '''
+    df['precinct'] = precincts.extract(df)
+    return df
+
+
+def trigger_dag(dagname: str, test: bool): 
+    '''Trigger dag via subprocess'''
+    if test: 
+        logger.info(f'TEST mode - not triggering DAG {dagname}')
+    else: 
+        dag_trigger.main(dagname)
+    print('DAG trigger complete')
+
+
+def get_database(test: bool, run_local: bool) -> pwp.PostgresqlExtDatabase: 
+    '''Return the peewee database, initialized on the shared connection pool on first use'''
+    if blank_db.deferred: 
+        init_db(config_db.get_engine(test=test, run_local=run_local), database=blank_db)
+    return blank_db
+
+
+def run_pipeline(publisher: SftpPublisher, test: bool, run_local: bool, asset_data: dict, 
+                 incremental: bool, engine_type: str, adaptive: bool, deadline: int, 
+                 no_cache: bool, stream: bool, export_formats: tuple[str]) -> list[str]: 
+    '''Run the Asset management process once, returning the names of any stages that 
+    did not succeed. See run.main() for the parameters.
+    - `asset_data`: Assets API response already requested by run.py; ignored with 
+    `stream`, where the records are requested as they are loaded'''
+    global precincts
+    if precincts == None: 
+        precincts = PrecinctExtractor()
+    database = get_database(test=test, run_local=run_local)
+    history_deadline = time.monotonic() + deadline
+    timer = utils.SimpleTimer()
+    stages = []
+    changed_ids = None  # Asset ids upserted or deleted; None if unknown
+    unchanged = False  # Whether no records were deleted or upserted
+
+    if stream: # Requested lazily, as the records are loaded
+        asset_data = iter_asset_records(run_local, Asset._meta.fields)
+    if asset_data is not None:
+        with database: 
+            migrate_db(database)
+        # Built concurrently on an existing table, outside of the transaction below
+        db_indexes.ensure_indexes(database.engine, db_indexes.model_indexes(Asset))
+        run_asset_history.get_engine(test=test, run_local=run_local) # Creates the work queue table
+        with database: 
+            Asset.create_table(safe=True)
+            # A pooled connection keeps its temp table from a previous run (--daemon)
+            Asset_Temp.create_table(temporary=True, safe=True)
+            Asset_Temp.truncate_table()
+
+            if stream: 
+                df = stream_to_temp(asset_data)
+            else: 
+                if len(asset_data['data']) == 0: 
+                    sys.exit('Assets API returned no assets - not updating any tables')
+                df = prepare_df(asset_data['data'])
+                load_temp(df)
+            precincts.save()
+            logger.info(precincts.summary())
+            ids_deleted = delete_removed_ids()
+
+            ids_upserted = upsert(df=df)
+            # Committed with the upsert, so no upserted id can be lost before its history is fetched
+            run_asset_history.enqueue_ids(database, [id[0] for id in ids_upserted])
+
+            unchanged = len(ids_deleted) == 0 and len(ids_upserted) == 0
+
+        ids = [id[0] for id in ids_upserted]
+        changed_ids = ids + ids_deleted
+
+        exported = {}
+        def export_assets(): # Get back the authoritative data from db
+            with database.connection_context(): # Each stage thread has its own connection
+                exported.update(export.export_assets(database, formats=['xlsx', *export_formats]))
+
+        def publish_exports(): 
+            if test: 
+                logger.info(f'TEST mode - Not uploading to SFTP')
+            futures = []
+            for file_name, fingerprint in exported.items(): 
+                if not test: 
+                    futures.append(publisher.publish(
+                        local_filename=file_name, 
+                        remote_filename=f'{config.SFTP_DIRECTORY}/{file_name}', 
+                        fingerprint=fingerprint))
+                else: 
+                    try: 
+                        os.remove(file_name)
+                        logger.info(f'Successfully removed local file copy\n')
+                    except FileNotFoundError: 
+                        logger.info(f'Unable to remove file {file_name}\n')
+            for future in futures: 
+                future.result()
+
+        history_processed = []  # Number of ids whose asset history was processed
+        def update_asset_history(): 
+            history_processed.append(run_asset_history.update(
+                test=test, run_local=run_local, incremental=incremental, engine_type=engine_type, 
+                adaptive=adaptive, deadline=history_deadline, use_cache=not no_cache))
+
+        def trigger_history_dags(): 
+            if unchanged and history_processed == [0]: 
+                logger.info('No asset history was processed - not triggering its DAGs\n')
+                return
+            trigger_dag(dagname=config.DAG_NAME_ASSET_HISTORY, test=test)
+            trigger_dag(dagname=config.DAG_NAME_POLLBOOK_LOCATIONS, test=test)
+
+        history_stages = [
+            Stage('asset_history', update_asset_history), 
+            Stage('trigger_asset_history_dags', trigger_history_dags, depends_on=('asset_history',)), 
+        ]
+        if unchanged: # Exit without triggering dag run if no records changed
+            logger.info(f'No records were deleted or upserted - data is unchanged')
+            logger.info(f'Not triggering any table updates, DAGs, or SFTP upload!\n')
+            # Only finish any asset history left in the work queue by a previous run
+            stages += history_stages
+        else: 
+            stages += [
+                Stage('export', export_assets), 
+                Stage('sftp_upload', publish_exports, depends_on=('export',)), 
+                Stage('trigger_assets_dag', lambda: trigger_dag(dagname=config.DAG_NAME_ASSETS, test=test)), 
+                *history_stages, 
+            ]
+    else: 
+        logger.info('No asset data found. Not updating asset history.\n')
+    
+    # Only needs the committed Assets table, so runs alongside the stages above. Its 
+    # tables are reflected and set up first, as the stages share the same metadata.
+    if not unchanged: 
+        router_tables = run_asset_router_locations.setup_tables(database.engine)
+        stages += [
+            Stage('router_locations', 
+                  lambda: run_asset_router_locations.main(test=test, run_local=run_local, ids=changed_ids, 
+                                                          tables=router_tables)), 
+            Stage('trigger_router_locations_dag', 
+                  lambda: trigger_dag(dagname=config.DAG_NAME_ASSET_ROUTER_LOCATIONS, test=test), 
+                  depends_on=('router_locations',)), 
+        ]
+    results = run_stages(stages, max_workers=config.STAGE_WORKERS)
+
+    logger.info(config_db.pool_summary(database.engine, reset=True))
+    logger.info(timer.end())
+    failed = [name for name, result in results.items() if result.status != SUCCEEDED]
+    if not failed: 
+        logger.info('Done!\n')
+    return failed
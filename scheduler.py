@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Sequence
+import collections, logging, threading, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class DeadlineScheduler():
+    '''Hand out ids in priority order until a deadline, after which no new work
+    starts and the remaining ids are deferred
+    ```
+    scheduler = DeadlineScheduler(ids, deadline=time.monotonic() + 300)
+    while (id := scheduler.next_id()) != None:
+        # process id
+    scheduler.deferred  # ids not started before the deadline
+    ```
+    Work already started when the deadline passes is allowed to finish.
+    - `ids`: Ids in priority order, highest first
+    - `deadline`: time.monotonic() value after which no new id is handed out
+    '''
+    def __init__(self, ids: Sequence[str], deadline: float):
+        self.deadline = deadline
+        self.total = len(ids)
+        self.started = 0
+        self.deferred = []
+        self._ids = collections.deque(ids)
+        self._lock = threading.Lock()
+
+    def remaining_seconds(self) -> float:
+        '''Seconds until the deadline, negative once passed'''
+        return self.deadline - time.monotonic()
+
+    def next_id(self) -> str:
+        '''Return the next id to process, or None if none remain or the deadline passed'''
+        with self._lock:
+            if self._ids and self.remaining_seconds() <= 0:
+                logger.warning(f'Asset history deadline reached - deferring '
+                               f'{len(self._ids):,} IDs to the next run')
+                self.deferred.extend(self._ids)
+                self._ids.clear()
+            if not self._ids:
+                return None
+            self.started += 1
+            return self._ids.popleft()
+
+    def run_threads(self, executor: ThreadPoolExecutor, func: Callable, max_workers: int):
+        '''Call func(id) on the executor with at most max_workers ids at a time,
+        submitting another id as each finishes until the deadline. Exceptions
+        raised by func are re-raised.'''
+        running = set()
+        while True:
+            while len(running) < max_workers and (id := self.next_id()) != None:
+                running.add(executor.submit(func, id))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
@@ -0,0 +1,79 @@
+import citygeo_secrets as cgs
+import config as conf
+from typing import Callable
+import collections, copy, logging, threading, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+_cache = {}  # Secret name -> (secret, time.monotonic() when fetched)
+_locks = collections.defaultdict(threading.Lock)  # Secret name -> lock held while fetching it
+_locks_lock = threading.Lock()
+
+
+def _lock(name: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks[name]
+
+
+def get_secrets(*names: str) -> dict:
+    '''Return a dict of secret name -> secret, like citygeo_secrets.get_secrets(),
+    fetching each secret at most once per conf.SECRETS_TTL_SECONDS
+
+    Threads that ask for a secret while it is being fetched wait for that fetch
+    rather than starting their own. Each caller gets its own copy of the secrets,
+    so modifying them does not affect the cache.'''
+    creds = {}
+    for name in names:
+        with _lock(name):
+            entry = _cache.get(name)
+            if entry == None or time.monotonic() - entry[1] > conf.SECRETS_TTL_SECONDS:
+                entry = (cgs.get_secrets(name)[name], time.monotonic())
+                _cache[name] = entry
+                logger.debug(f'Fetched secret "{name}"')
+            creds[name] = copy.deepcopy(entry[0])
+    return creds
+
+
+def is_auth_error(e: BaseException) -> bool:
+    '''Whether an error means that a credential was rejected: an HTTP 401, a
+    paramiko AuthenticationException, or a database "authentication failed"'''
+    response = getattr(e, 'response', None)
+    if getattr(response, 'status_code', None) == 401:
+        return True
+    if any(cls.__name__ == 'AuthenticationException' for cls in type(e).__mro__):
+        return True
+    return 'authentication failed' in str(e).lower()
+
+
+def connect_with_secrets(func: Callable, *names: str, **kwargs):
+    '''Return func(creds, **kwargs) with the secrets from get_secrets(*names), in
+    place of citygeo_secrets.connect_with_secrets()
+
+    If func fails because a secret was rejected (see is_auth_error()), the secrets
+    may have been rotated since they were cached, so they are invalidated and
+    func is called once more with freshly fetched secrets.'''
+    try:
+        return func(get_secrets(*names), **kwargs)
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning(f'Secrets {names} were rejected ({e!r}) - fetching them again and retrying')
+        invalidate(*names)
+        return func(get_secrets(*names), **kwargs)
+
+
+def update_secret(name: str, values: dict):
+    '''Update fields of a secret in the secrets manager and in the cache'''
+    with _lock(name):
+        cgs.update_secret(name, values)
+        if name in _cache:
+            _cache[name][0].update(copy.deepcopy(values))
+
+
+def invalidate(*names: str):
+    '''Drop secrets from the cache so that they are fetched again on next use'''
+    for name in names:
+        with _lock(name):
+            _cache.pop(name, None)
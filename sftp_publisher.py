@@ -0,0 +1,103 @@
+from assetdetails import get_sftp_conn
+from concurrent.futures import Future, ThreadPoolExecutor
+import config as conf
+import secrets_cache
+import json, logging, os
+
+
+global logger
+logger = logging.getLogger('main')
+
+
+class SftpPublisher():
+    '''Upload files to the SFTP server in a background thread, over one connection
+    that is opened on the first upload and reused
+    ```
+    publisher = SftpPublisher()
+    publisher.publish(local_filename, remote_filename, fingerprint)  # Returns immediately
+    # ... other work
+    publisher.close()  # Wait for the uploads and close the connection
+    ```
+    Each file is uploaded under a temporary name and then renamed, so readers
+    never see a partial file. The fingerprint of the last file uploaded to each
+    remote path is kept in `state_path`, and a file with the same fingerprint as
+    the one already on the server is not uploaded again.
+    '''
+    def __init__(self, state_path: str = conf.SFTP_STATE_PATH):
+        self.state_path = state_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sftp')
+        self._conn = None
+        self._sftp = None
+        try:
+            with open(state_path) as f:
+                self._published = json.load(f)
+        except FileNotFoundError:
+            self._published = {}
+        except ValueError as e:
+            logger.warning(f'Ignoring unreadable SFTP state {state_path}: {e!r}')
+            self._published = {}
+
+    def publish(self, local_filename: str, remote_filename: str, fingerprint: str = None,
+                remove_local: bool = True) -> Future:
+        '''Queue a file for upload, returning a Future of whether it was uploaded
+        - `fingerprint`: Content fingerprint of the file; if None it is always uploaded
+        - `remove_local`: Delete the local file once done, whether or not it was uploaded'''
+        return self._executor.submit(
+            self._upload, local_filename, remote_filename, fingerprint, remove_local)
+
+    def _client(self):
+        '''Return the pooled SFTP client, connecting first if needed'''
+        if self._sftp == None or not self._conn.is_connected:
+            self._conn = secrets_cache.connect_with_secrets(get_sftp_conn, conf.SFTP_SECRET)
+            self._sftp = self._conn.sftp()
+        return self._sftp
+
+    def _upload(self, local_filename: str, remote_filename: str, fingerprint: str,
+                remove_local: bool) -> bool:
+        from paramiko.ssh_exception import NoValidConnectionsError # Only imported by runs that upload
+        try:
+            if fingerprint != None and self._published.get(remote_filename) == fingerprint:
+                logger.info(f'"{remote_filename}" is unchanged since its last upload - skipping SFTP upload\n')
+                return False
+            sftp = self._client()
+            temp_filename = f'{remote_filename}.uploading'
+            sftp.put(local_filename, temp_filename)
+            try:
+                sftp.posix_rename(temp_filename, remote_filename)
+            except IOError: # Server without the posix-rename extension, which replaces atomically
+                try:
+                    sftp.remove(remote_filename)
+                except IOError:
+                    pass
+                sftp.rename(temp_filename, remote_filename)
+            logger.info(f'Successfully uploaded file to SFTP server at "{remote_filename}"\n')
+            self._published[remote_filename] = fingerprint
+            self._save()
+            return True
+        except NoValidConnectionsError as e:
+            logger.error(f'Unable to upload to SFTP!')
+            logger.error(e)
+            return False
+        finally:
+            if remove_local:
+                try:
+                    os.remove(local_filename)
+                    logger.info(f'Successfully removed local file copy {local_filename}\n')
+                except FileNotFoundError:
+                    logger.info(f'Unable to remove file {local_filename}\n')
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            json.dump(self._published, f)
+
+    def close(self):
+        '''Wait for queued uploads and close the connection. Errors of the uploads
+        are left to whoever holds their Futures; errors closing are logged.'''
+        self._executor.shutdown(wait=True)
+        if self._sftp != None:
+            try:
+                self._sftp.close()
+                self._conn.close()
+            except Exception as e:
+                logger.warning(f'Error closing the SFTP connection: {e!r}')
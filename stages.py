@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, NamedTuple, Sequence
+import logging, time
+
+
+global logger
+logger = logging.getLogger('main')
+
+SUCCEEDED, FAILED, SKIPPED = 'succeeded', 'failed', 'skipped'
+
+
+class Stage(NamedTuple):
+    '''One step of the pipeline
+    - `name`: Unique name, used in `depends_on` and the timing report
+    - `func`: Called with no arguments
+    - `depends_on`: Names of stages that must succeed before this one starts'''
+    name: str
+    func: Callable[[], object]
+    depends_on: tuple[str, ...] = ()
+
+
+class StageResult(NamedTuple):
+    status: str
+    seconds: float
+    error: BaseException = None
+
+
+def run_stages(stages: Sequence[Stage], max_workers: int) -> dict[str, StageResult]:
+    '''Run stages on a thread pool, each as soon as all of its dependencies have
+    succeeded, and return the result of each stage by name
+
+    A stage that raises is logged and marked failed without stopping stages that
+    do not depend on it; stages that depend on a failed or skipped stage are skipped.
+    A timing report of every stage is logged at the end.'''
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = set(stage.depends_on) - set(by_name)
+        assert not missing, f'Stage {stage.name} depends on unknown stage(s) {missing}'
+
+    results = {}
+    pending = list(stages)
+    running = {}  # Future -> (stage, time.monotonic() when started)
+
+    def run_stage(stage: Stage):
+        logger.info(f'Starting stage {stage.name}\n')
+        stage.func()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stage') as executor:
+        while pending or running:
+            count_pending = len(pending)
+            for stage in list(pending):
+                statuses = [results[name].status if name in results else None
+                            for name in stage.depends_on]
+                if any(status in (FAILED, SKIPPED) for status in statuses):
+                    pending.remove(stage)
+                    results[stage.name] = StageResult(SKIPPED, 0.0)
+                    logger.warning(f'Skipping stage {stage.name} - a dependency did not succeed')
+                elif all(status == SUCCEEDED for status in statuses):
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage)] = (stage, time.monotonic())
+            if not running:
+                assert len(pending) < count_pending, f'Stage dependencies form a cycle: {pending}'
+                continue # Stages were only skipped; check their dependents
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, started = running.pop(future)
+                seconds = time.monotonic() - started
+                error = future.exception()
+                if error != None:
+                    logger.error(f'Stage {stage.name} failed after {seconds:,.1f}s',
+                                 exc_info=error)
+                    results[stage.name] = StageResult(FAILED, seconds, error)
+                else:
+                    results[stage.name] = StageResult(SUCCEEDED, seconds)
+
+    report = '\n'.join(f'\t{stage.name:<32} {results[stage.name].status:<10} '
+                       f'{results[stage.name].seconds:>8,.1f}s' for stage in stages)
+    logger.info(f'Stage timings:\n{report}\n')
+    return results